@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Startup time benchmark of DbusPvBoilerService
+
+Starts the service repeatedly against the modbus simulator with the fake endpoints
+of benchmark_update.py, alternating a cold start (no warm start file) and a warm
+start (the file the previous run left behind). Measured per start:
+
+    startup         time of the service constructor, until the update loop could run
+    first_cycle     time of the first update cycle with all bus results delivered
+    transactions    modbus requests during the constructor
+    resumed         whether the heater target of the previous run was taken back
+
+    python benchmark_startup.py --runs 5 --output bench_startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+from time import perf_counter
+
+from benchmark_update import (
+    git_version,
+    idle_calls,
+    install_fakes,
+    load_service_module,
+    start_simulator,
+    summary,
+)
+
+SAVED_TARGET = 1500  # W, heater target of the state each run leaves behind
+
+
+def start(service_module, link):
+    begin = perf_counter()
+    service = service_module.DbusPvBoilerService(
+        port=link,
+        servicename="com.victronenergy.pvinverter.benchmark",
+    )
+    startup = perf_counter() - begin
+    transactions = sum(channel.counters["requests"] for channel in service.rs485.slaves.values())
+    resumed = service.heater_target
+
+    begin = perf_counter()
+    service._update()
+    while service.bus.is_pending("inverter") or service.bus.is_pending("heater") or not idle_calls.empty():
+        callback, cb_args = idle_calls.get(timeout=10)
+        callback(*cb_args)
+    first_cycle = perf_counter() - begin
+    return service, {"startup": startup, "first_cycle": first_cycle, "transactions": transactions, "target": resumed}
+
+
+def run(args):
+    install_fakes()
+    service_module = load_service_module()
+    state = tempfile.mkdtemp()
+    service_module.HISTORY_FILE = os.path.join(state, "history.bin")
+    service_module.ENERGY_FILE = os.path.join(state, "energy.json")
+    service_module.WARM_START_FILE = os.path.join(state, "warmstart.json")
+    service_module.CONFIG_FILE = None
+
+    link = os.path.join(tempfile.mkdtemp(), "ttySIM")
+    simulator = start_simulator(args, link)
+    results = {"cold": [], "warm": []}
+    try:
+        for _ in range(args.runs):
+            for kind in ("cold", "warm"):
+                if kind == "cold" and os.path.exists(service_module.WARM_START_FILE):
+                    os.remove(service_module.WARM_START_FILE)
+                service, sample = start(service_module, link)
+                sample["resumed"] = sample.pop("target") == SAVED_TARGET
+                results[kind].append(sample)
+                # the state a restart right now would find
+                service.heater_target = SAVED_TARGET
+                service.warm.save(service._control_snapshot())
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    return {
+        "version": service_module.VERSION,
+        "git": git_version(),
+        "python": platform.python_version(),
+        "settings": {"runs": args.runs, "baudrate": args.baudrate, "latency": args.latency},
+        "results": {
+            kind: {
+                "startup": summary([s["startup"] for s in samples]),
+                "first_cycle": summary([s["first_cycle"] for s in samples]),
+                "transactions": max(s["transactions"] for s in samples),
+                "resumed": sum(s["resumed"] for s in samples),
+            }
+            for kind, samples in results.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time benchmark of the PV boiler service")
+    parser.add_argument("--runs", type=int, default=5, help="cold and warm starts each (default: 5)")
+    parser.add_argument("--baudrate", type=int, default=9600, help="line speed (default: 9600)")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated slave latency in s (default: 0.01)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    args.drop = args.crc = 0.0
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""
+Loop latency benchmark of DbusPvBoilerService._update
+
+Runs the real service against the modbus simulator (in a separate process, so it
+doesn't count as our cpu time) with fake D-Bus, GLib and MQTT endpoints, and
+measures every update cycle:
+
+    update          time _update blocks the main loop
+    cycle           time until the results of all queued bus jobs are delivered
+    cpu             process cpu time of the cycle
+    inverter_read   s5_inverter.poll of all inverters (bus owner thread)
+    heater_operate  WaterHeater.operate of all heaters (bus owner thread)
+    grid_meter      DbusMonitor lookups
+    mqtt_publish    queuing the MQTT sample (publishing runs in the mqtt thread)
+    dbus_write      all VeDbusService item writes
+
+Results are written as JSON, so runs can be compared across versions and serial settings:
+
+    python benchmark_update.py --cycles 300 --baudrate 9600 --output bench_9600.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import types
+from time import perf_counter, process_time, sleep
+
+PHASES = ("inverter_read", "heater_operate", "grid_meter", "mqtt_publish", "dbus_write")
+
+current = dict.fromkeys(PHASES, 0.0)  # phase times of the running cycle
+idle_calls = queue.Queue()  # GLib.idle_add calls from the bus owner thread
+
+
+def timed(phase, function):
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current[phase] += perf_counter() - start
+
+    return wrapper
+
+
+class FakeGLib(types.ModuleType):
+    def __init__(self):
+        super().__init__("GLib")
+
+    @staticmethod
+    def timeout_add(interval, callback, *args):
+        return 1  # the benchmark calls _update itself
+
+    @staticmethod
+    def idle_add(callback, *args):
+        idle_calls.put((callback, args))
+        return 1
+
+    class MainLoop:
+        def run(self):
+            pass
+
+
+class FakeVeDbusService:
+    def __init__(self, servicename, *args, **kwargs):
+        self.servicename = servicename
+        self._dbusconn = None
+        self._values = {}
+
+    def add_path(self, path, value, **kwargs):
+        self._values[path] = value
+
+    def __getitem__(self, path):
+        return self._values[path]
+
+    def __setitem__(self, path, value):
+        start = perf_counter()
+        self._values[path] = value
+        current["dbus_write"] += perf_counter() - start
+
+    def __enter__(self):
+        return self  # batched writes, like velib_python's ServiceContext
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FakeDbusMonitor:
+    """A grid meter whose power drifts randomly around 1.5 kW feed-in"""
+
+    def __init__(self, tree, *args, **kwargs):
+        self.random = random.Random(0)
+        self.power = -1500.0
+
+    def get_service_list(self, classfilter=None):
+        return {"com.victronenergy.grid.sim": 30}
+
+    def get_value(self, service, path, default=None):
+        self.power = min(max(self.power + self.random.uniform(-200, 200), -4000), 1000)
+        return self.power
+
+
+class FakeSettingsDevice:
+    def __init__(self, bus, supportedSettings, eventCallback, *args, **kwargs):
+        self._values = {name: setting[1] for name, setting in supportedSettings.items()}
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+
+class FakeMqttClient:
+    def __init__(self, *args, **kwargs):
+        self.on_connect = self.on_disconnect = self.on_message = None
+
+    def connect(self, *args, **kwargs):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def will_set(self, *args, **kwargs):
+        pass
+
+    def loop(self, timeout=1.0):
+        return 0
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        pass
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+    def message_callback_add(self, *args, **kwargs):
+        pass
+
+
+class FakeDbusObject:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def install_fakes():
+    """Fake endpoints instead of D-Bus, GLib and the MQTT broker"""
+
+    def module(name, **attributes):
+        m = types.ModuleType(name)
+        m.__dict__.update(attributes)
+        sys.modules[name] = m
+        return m
+
+    glib = FakeGLib()
+    module("gi", repository=module("gi.repository", GLib=glib))
+    service = module("dbus.service", Object=FakeDbusObject, method=lambda *a, **k: lambda f: f)
+    module("dbus", SystemBus=lambda *a, **k: None, SessionBus=lambda *a, **k: None, Array=list, service=service)
+    module("vedbus", VeDbusService=FakeVeDbusService)
+    module("dbusmonitor", DbusMonitor=FakeDbusMonitor)
+    module("settingsdevice", SettingsDevice=FakeSettingsDevice)
+    client = module("paho.mqtt.client", Client=FakeMqttClient)
+    module("paho", mqtt=module("paho.mqtt", client=client))
+
+
+def load_service_module():
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dbus-pvboiler.py")
+    spec = importlib.util.spec_from_file_location("dbus_pvboiler", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    return {
+        "p50_ms": percentile(values, 50) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": max(values) * 1000,
+        "mean_ms": sum(values) / len(values) * 1000,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def start_simulator(args, link):
+    simulator = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.realpath(__file__)), "modbus_simulator.py"),
+            "--link", link,
+            "--baudrate", str(args.baudrate),
+            "--latency", str(args.latency),
+            "--drop", str(args.drop),
+            "--crc", str(args.crc),
+            "--seed", "1",
+        ]
+    )
+    for _ in range(100):
+        if os.path.exists(link):
+            return simulator
+        sleep(0.05)
+    simulator.kill()
+    raise RuntimeError("Simulator didn't start")
+
+
+def run(args):
+    install_fakes()
+    service_module = load_service_module()
+    service_module.BAUDRATE = args.baudrate
+    state = tempfile.mkdtemp()
+    service_module.HISTORY_FILE = os.path.join(state, "history.bin")
+    service_module.ENERGY_FILE = os.path.join(state, "energy.json")
+    service_module.WARM_START_FILE = os.path.join(state, "warmstart.json")
+    service_module.CONFIG_FILE = None
+    for profile in service_module.SERIAL_PROFILES.values():
+        profile["baudrates"] = [args.baudrate]
+
+    link = os.path.join(tempfile.mkdtemp(), "ttySIM")
+    simulator = start_simulator(args, link)
+    try:
+        service = service_module.DbusPvBoilerService(
+            port=link,
+            servicename="com.victronenergy.pvinverter.benchmark",
+        )
+        for inverter in service.inverters:
+            inverter.poll = timed("inverter_read", inverter.poll)
+        for heater in service.heaters:
+            heater.operate = timed("heater_operate", heater.operate)
+        service.monitor.get_value = timed("grid_meter", service.monitor.get_value)
+        service.monitor.get_service_list = timed("grid_meter", service.monitor.get_service_list)
+        service.mqtt.submit = timed("mqtt_publish", service.mqtt.submit)
+
+        submitted = [0]
+        submit = service.bus.submit
+
+        def counting_submit(*a, **kw):
+            queued = submit(*a, **kw)
+            submitted[0] += queued
+            return queued
+
+        service.bus.submit = counting_submit
+
+        samples = {name: [] for name in ("update", "cycle", "cpu") + PHASES}
+        for _ in range(args.cycles):
+            for phase in PHASES:
+                current[phase] = 0.0
+            submitted[0] = 0
+            start = perf_counter()
+            cpu = process_time()
+            service._update()
+            samples["update"].append(perf_counter() - start)
+            # deliver the bus job results like the GLib main loop would
+            for _ in range(submitted[0]):
+                callback, cb_args = idle_calls.get(timeout=10)
+                callback(*cb_args)
+            samples["cycle"].append(perf_counter() - start)
+            samples["cpu"].append(process_time() - cpu)
+            for phase in PHASES:
+                samples[phase].append(current[phase])
+            if args.paced:
+                sleep(max(0, service_module.LOOPTIME / 1000 - (perf_counter() - start)))
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    return {
+        "version": service_module.VERSION,
+        "git": git_version(),
+        "python": platform.python_version(),
+        "settings": {
+            "cycles": args.cycles,
+            "baudrate": args.baudrate,
+            "latency": args.latency,
+            "drop": args.drop,
+            "crc": args.crc,
+            "paced": args.paced,
+        },
+        "results": {name: summary(values) for name, values in samples.items()},
+        "counters": {
+            str(address): channel.counters for address, channel in service.rs485.slaves.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loop latency benchmark of the PV boiler update cycle")
+    parser.add_argument("--cycles", type=int, default=100, help="number of update cycles (default: 100)")
+    parser.add_argument("--baudrate", type=int, default=9600, help="line speed (default: 9600)")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated slave latency in s (default: 0.01)")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of a dropped reply (default: 0)")
+    parser.add_argument("--crc", type=float, default=0.0, help="probability of a CRC error (default: 0)")
+    parser.add_argument("--paced", action="store_true", help="keep the LOOPTIME cadence instead of running back to back")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Replay test bench of the surplus controllers
+
+Every controller runs against the same PV and household load profile, second by
+second. The profile is either synthesized from a seed (a clear sky day with passing
+clouds and appliance switching) or replayed from a CSV file with the columns
+
+    time,pv,load        s, W, W
+
+The heater is the real WaterHeater power stage model, learning its element power as
+in operation. A relay command takes effect one step after the controller's request
+(the bus transaction) and the heater draws ELEMENT_FACTOR of its rated power.
+The water never gets hot in the bench.
+Scores per controller:
+
+    import_kwh          grid import caused by the heater (import up to the heater power)
+    unused_export_kwh   export the heater could have taken with its free elements
+    switches_per_hour   relay toggles
+
+    python controller_bench.py --hours 8 --seed 1 --output bench_controller.json
+"""
+import argparse
+import csv
+import json
+import math
+import random
+
+from surplus_controller import CONTROLLERS, make_controller
+from water_heater import WaterHeater
+
+ELEMENT_FACTOR = 0.96  # measured power of the elements relative to their rating
+RATED_POWER = 6000  # W of the simulated inverter
+
+
+def synthetic_profile(hours, seed):
+    """(pv, load) per second of a day's middle hours, the same for the same seed"""
+    rnd = random.Random(seed)
+    seconds = int(hours * 3600)
+    cloud, cloud_target = 1.0, 1.0
+    load, appliance_end = 300.0, 0
+    for t in range(seconds):
+        if rnd.random() < 1 / 300:
+            cloud_target = rnd.choice((1.0, 1.0, 0.8, 0.5, 0.25))
+        cloud += (cloud_target - cloud) / 20  # clouds pass in tens of seconds
+        pv = RATED_POWER * 0.85 * math.sin(math.pi * (0.15 + 0.7 * t / seconds)) * cloud
+        if t >= appliance_end and rnd.random() < 1 / 600:
+            load = 300 + rnd.choice((150, 800, 2000, 2200))  # fridge, washer, kettle, oven
+            appliance_end = t + rnd.randint(60, 900)
+        elif t >= appliance_end:
+            load = 300.0
+        yield pv, load + rnd.uniform(-30, 30)
+
+
+def csv_profile(filename):
+    with open(filename, newline="") as f:
+        rows = [(float(r["time"]), float(r["pv"]), float(r["load"])) for r in csv.DictReader(f)]
+    # resample to 1 s, holding the last value
+    if not rows:
+        return
+    row = 0
+    for t in range(int(rows[-1][0] - rows[0][0]) + 1):
+        while row + 1 < len(rows) and rows[row + 1][0] - rows[0][0] <= t:
+            row += 1
+        yield rows[row][1], rows[row][2]
+
+
+def run(controller, heater, profile):
+    elements = heater.model.elements
+    heater_max = ELEMENT_FACTOR * sum(elements)
+    pending = None
+    imported = unused = 0.0  # Ws
+    switches = seconds = 0
+    for t, (pv, load) in enumerate(profile):
+        steady = pending is None
+        if pending is not None:
+            switches += sum(a != b for a, b in zip(heater.cmd_bits, pending))
+            heater.cmd_bits, pending = pending, None
+        heater_power = ELEMENT_FACTOR * sum(w for w, bit in zip(elements, heater.cmd_bits) if bit)
+        if steady:
+            heater.model.learn(heater.cmd_bits, heater_power)
+        grid = load + heater_power - pv
+        if grid > 0:
+            imported += min(grid, heater_power)
+        else:
+            unused += min(-grid, heater_max - heater_power)
+        request = controller.update(grid, heater_power, pv, float(t))
+        if request is not None:
+            pending = heater.calc_powercmd(request)
+        seconds += 1
+    hours = seconds / 3600
+    return {
+        "import_kwh": round(imported / 3.6e6, 3),
+        "unused_export_kwh": round(unused / 3.6e6, 3),
+        "switches_per_hour": round(switches / hours, 1) if hours else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Surplus controller replay bench")
+    parser.add_argument("--hours", type=float, default=8, help="length of the synthetic profile")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic profile")
+    parser.add_argument("--input", help="CSV profile with time,pv,load columns instead of the synthetic one")
+    parser.add_argument("--offset", type=float, default=200, help="surplus offset of the rules controller in W")
+    parser.add_argument(
+        "--controllers", default=",".join(CONTROLLERS), help="comma separated controllers to score"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.controllers.split(","):
+        heater = WaterHeater(None)
+        controller = make_controller(name, heater.step_power, args.offset)
+        profile = csv_profile(args.input) if args.input else synthetic_profile(args.hours, args.seed)
+        results[name] = run(controller, heater, profile)
+        print(
+            f"{name:8} import {results[name]['import_kwh']:7.3f} kWh  "
+            f"unused export {results[name]['unused_export_kwh']:7.3f} kWh  "
+            f"switches {results[name]['switches_per_hour']:6.1f}/h"
+        )
+
+    if args.output:
+        settings = {"hours": args.hours, "seed": args.seed, "input": args.input, "offset": args.offset}
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
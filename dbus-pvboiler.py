@@ -7,14 +7,16 @@ and a modbus rtu pv inverter of type Solis S5. The PV production is measured and
 energy, but not more
 Both devices are connected by the same modbus, so only a single serial port is used
 """
-from time import sleep
+from time import sleep, time
 from gi.repository import GLib as gobject
 import platform
 import logging
 import sys
 import os
 import dbus
+import json
 import _thread as thread
+from collections import deque
 import minimalmodbus
 import paho.mqtt.client as mqtt
 from timeit import default_timer as timer
@@ -31,17 +33,79 @@ from vedbus import VeDbusService
 from dbusmonitor import DbusMonitor
 from settingsdevice import SettingsDevice  # available in the velib_python repository
 from water_heater import WaterHeater
-from solis_s5_inverter import s5_inverter
+from solis_s5_inverter import s5_inverter, PRIO_CONTROL, PRIO_AC, PRIO_IDENTITY
+from poll_scheduler import PollScheduler
+from modbus_bus import (
+    BusOwner,
+    PRIO_CONTROL as BUS_PRIO_CONTROL,
+    PRIO_TELEMETRY as BUS_PRIO_TELEMETRY,
+    PRIO_BACKGROUND as BUS_PRIO_BACKGROUND,
+)
+from rs485_transport import Rs485Port, SerialProfile
+from loop_timer import CadenceTimer
+from dbus_publisher import DbusPublisher
+from mqtt_pipeline import MqttPipeline
+from mqtt_connection import MqttConnection
+from modbus_stats import percentile
+from surplus_controller import make_controller
+from history import History, FIELDS as HISTORY_FIELDS
+from history_dbus import HistoryObject
+from energy_counter import EnergyCounter
+from load_manager import Load, LoadManager
+from inverter_unit import InverterUnit, total_ac_values, identity_values
+from frame_log import FrameLog
+from warm_start import WarmStart
+from service_config import load_config, changes, RESTART_OPTIONS
+from device_health import DeviceHealth
 
 VERSION = 0.4
 SERVER_ADDRESS_BOILER = 33  # Modbus ID of the Water Heater Device
-SERVER_ADDRESS_INVERTER = 1  # Modbus ID of the PV Inverter
-BAUDRATE = 9600
+SERVER_ADDRESSES_INVERTER = [1]  # Modbus IDs of the PV Inverters on the line, several get a pvinverter service each
+BAUDRATE = 9600  # of the port, each slave switches it to its own profile
+# per slave: candidate baud rates (the fastest that answers reliably is probed at startup),
+# parity and timeouts in s. timeout is the initial value, then it is learned within min/max.
+# "inverter" is used for all inverters without a profile of their own
+SERIAL_PROFILES = {
+    "inverter": {
+        "baudrates": [9600],
+        "parity": "N",
+        "timeout": 0.2,  # the Solis needs some time to answer
+        "min_timeout": 0.03,
+        "max_timeout": 0.5,
+    },
+    SERVER_ADDRESS_BOILER: {
+        "baudrates": [9600],  # add 19200, 38400 ... if the heater firmware supports it
+        "parity": "N",
+        "timeout": 0.1,  # the heater controller answers within a few ms
+        "min_timeout": 0.03,
+        "max_timeout": 0.5,
+    },
+}
 GRIDMETER_KEY_WORD = "com.victronenergy.grid"
 SURPLUS_OFFSET = 200  # offset that must be generated more than the boiler would consume
+HEATER_ELEMENTS = [500, 1000, 2000]  # W of the heating elements, in the order of the heater's coils
+# heaters sharing the surplus, the first is the boiler with the /Heater paths and settings.
+# priority: lower numbers get the surplus first, target_temperature in °C,
+# switch_time: s after a change before a heater may step up again
+HEATERS = [
+    {"address": SERVER_ADDRESS_BOILER, "elements": HEATER_ELEMENTS, "priority": 1, "switch_time": 6},
+    # {"address": 34, "elements": [2000, 2000], "priority": 2, "target_temperature": 70, "switch_time": 6},
+]
+BOILER_IS_OPTIONAL = True  # optionally, use this driver just as a inverter monitor
+HEATER_READ_WRITE_MULTIPLE = False  # heater firmware with function 23: one transaction per cycle
+CONTROLLER = "rules"  # surplus controller, "rules": fixed switching rules, "pi": PI with PV feed-forward
 LOOPTIME = 1000 # update loop time in ms
+BUS_BUDGET = 600  # ms of each update cycle that may be spent reading telemetry, the rest is reserve for timeouts
+AC_READ_INTERVAL = 1  # cycles between energy and phase reads, raise if the bus gets crowded
+IDENTITY_READ_INTERVAL = 3600  # cycles between type and version reads
+STATS_INTERVAL = 10  # cycles between publishing the modbus statistics
+REACTION_SAMPLES = 100  # grid meter triggered downsteps kept for the reaction time statistics
 
 Broker_Address = "192.168.168.112"
+MQTT_MODE = "topics"  # "topics": one message per value (legacy), "json" or "cbor": one message per cycle
+MQTT_MAX_AGE = 60  # s, unchanged values are published again after this time
+MQTT_QUEUE_SIZE = 100  # messages waiting for the mqtt thread, the oldest is dropped when full
+MQTT_BUFFER_SIZE = 3600  # samples kept while the broker is offline, replayed after reconnect
 InverterType = "pvboiler"
 Topics = {
     "pvpower": "iot/pv/solis/ac_active_power_kW",
@@ -51,10 +115,64 @@ Topics = {
     "heatertemperature": "iot/pv/boiler/temperature",
     "heatertargettemperature": "iot/pv/boiler/targettemperature",
     "heartbeat": "iot/pv/boiler/heartbeat",
+    "modbusstats": "iot/pv/boiler/modbus",
+    "samples": "iot/pv/boiler/samples",
+    "heaterenergytoday": "iot/pv/boiler/energy/today",  # kWh
+    "heaterenergytotal": "iot/pv/boiler/energy/total",
+    "heaterdivertedtoday": "iot/pv/boiler/energy/diverted_today",  # kWh of PV surplus
+    "heaterdivertedtotal": "iot/pv/boiler/energy/diverted_total",
+    "historyrequest": "iot/pv/boiler/history/request",  # {"id": .., "resolution": "1s"|"1m"|"15m", "start": .., "end": ..}
+    "historyresponse": "iot/pv/boiler/history/response",
 }
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "history.bin")
+ENERGY_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "energy.json")
+WARM_START_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "warmstart.json")
+FRAME_LOG_FILE = None  # record all modbus frames to this file for frame_replay.py, e.g. "/data/frames.bin"
+FRAME_LOG_SIZE = 4 * 1024 * 1024  # bytes per file, the previous one is kept as .1
+# overrides the settings above, kept over firmware updates. see config.sample.ini
+CONFIG_FILE = "/data/etc/dbus-pvboiler/config.ini"
+CONFIG_CHECK_INTERVAL = 5  # s between checks of the config file for changes
 
 path_UpdateIndex = "/UpdateIndex"
 
+# changes smaller than max(absolute, relative * |value|) are not published on dbus
+Deadbands = {
+    "/Ac/*Power": (5, 0.005),  # W
+    "/Ac/*Current": (0.05, 0),  # A
+    "/Ac/*Voltage": (0.5, 0),  # V
+    "/Ac/Energy/Forward": (0, 0),  # kWh
+    "/Heater/SurplusPower": (20, 0.01),  # W
+    "/Heater/Temperature": (0.1, 0),  # °C
+    "/Heater/*/Temperature": (0.1, 0),  # °C
+    "/Heater/Energy/*": (0.001, 0),  # kWh
+}
+
+
+def default_config():
+    """The settings of the constants above, the config file overrides them"""
+    return {
+        "broker_address": Broker_Address,
+        "topics": dict(Topics),
+        "mqtt_mode": MQTT_MODE,
+        "mqtt_max_age": MQTT_MAX_AGE,
+        "controller": CONTROLLER,
+        "surplus_offset": SURPLUS_OFFSET,
+        "looptime": LOOPTIME,
+        "boiler_is_optional": BOILER_IS_OPTIONAL,
+        "bus_budget": BUS_BUDGET,
+        "ac_read_interval": AC_READ_INTERVAL,
+        "identity_read_interval": IDENTITY_READ_INTERVAL,
+        "inverter_addresses": list(SERVER_ADDRESSES_INVERTER),
+        "boiler_address": HEATERS[0]["address"],
+    }
+
+
+def read_config():
+    """default_config() with the options of CONFIG_FILE, raises OSError or ValueError"""
+    if CONFIG_FILE is None:
+        return default_config()
+    return load_config(CONFIG_FILE, default_config())
+
 
 class DbusPvBoilerService:
     def __init__(
@@ -64,47 +182,121 @@ class DbusPvBoilerService:
         deviceinstance=288,
         productname="PV Boiler",
         connection="unknown",
-        topics={"top": "/my/pv/inverter"},
-        broker_address="127.0.0.1",
+        config=None,
     ):
         try:
-            self.boiler_is_optional = True  # optionally, use this driver just as a inverter monitor. TODO make this configurable
-            self.broker_address = broker_address
-            self.is_connected = False
+            # settings of the constants and the config file, replaced as a whole on a reload
+            self.config = config = config if config is not None else default_config()
+            self.config_mtime = self._config_mtime()
+            self.boiler_is_optional = config["boiler_is_optional"]
             self.is_online = False
-            self.topics = topics
+            topics = config["topics"]
             self.client = mqtt.Client("Venus_PV_Boiler")
-            self.client.on_disconnect = self.on_disconnect
-            self.client.on_connect = self.on_connect
             self.client.on_message = self.on_message
-            self.client.connect(broker_address)  # connect to broker
-            self.client.will_set(Topics["status"], "offline", retain=True)
+            # connecting happens in the mqtt thread, an unreachable broker can't stall startup
+            self.mqtt_connection = MqttConnection(
+                self.client, config["broker_address"], topics["status"], subscriptions=[topics["historyrequest"]]
+            )
+            self.client.message_callback_add(topics["historyrequest"], self._on_history_request)
             self.logCounter = 0 #  counter for log suppression
+            self.statsCounter = 0
+            self._debug_paths = set()
 
-            self.client.loop_start()
+            # publishing runs in its own thread, the update loop only queues samples
+            self.mqtt = MqttPipeline(
+                self.client,
+                topics,
+                self.mqtt_connection,
+                config["mqtt_mode"],
+                config["mqtt_max_age"],
+                MQTT_QUEUE_SIZE,
+                MQTT_BUFFER_SIZE,
+            )
+            self.mqtt.start()
             self._dbusservice = VeDbusService(servicename)
+            # 1 s, 1 min and 15 min history in fixed memory, written to flash every 15 min
+            self.history = History(HISTORY_FILE)
+            self.history_object = HistoryObject(self._dbusservice._dbusconn, self.history)
+            self.energy = EnergyCounter(ENERGY_FILE)
+            # all cyclic writes go through the publisher, one batch per cycle
+            self.publisher = DbusPublisher(self._dbusservice, Deadbands)
 
             logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
 
-            self.instrument_inverter = minimalmodbus.Instrument(
-                port, SERVER_ADDRESS_INVERTER
-            )
-            self.instrument_inverter.serial.baudrate = BAUDRATE
-            self.instrument_inverter.serial.timeout = 0.2
-            self.inverter = s5_inverter(self.instrument_inverter)
+            # known slaves are validated with one read, the control resumes after a quick restart
+            self.warm = WarmStart(WARM_START_FILE)
 
-            self.instrument_boiler = minimalmodbus.Instrument(
-                port, SERVER_ADDRESS_BOILER
-            )
-            self.boiler = WaterHeater(self.instrument_boiler)
+            # all slaves share one port, the transport keeps them from spoiling each other's frames
+            frame_log = FrameLog(FRAME_LOG_FILE, FRAME_LOG_SIZE) if FRAME_LOG_FILE else None
+            self.rs485 = Rs485Port(port, BAUDRATE, frame_log=frame_log)
+            self.bus = BusOwner()
+            # heater control may cut in between two block reads of an inverter
+            self.poller = PollScheduler(config["bus_budget"] / 1000, self.bus.run_urgent)
+            # per slave address, a slave that fails is probed again instead of ending the service
+            self.health = {}
+            self.inverters = []
+            for address in config["inverter_addresses"]:
+                channel = self.rs485.slave(
+                    address, SerialProfile(**SERIAL_PROFILES.get(address, SERIAL_PROFILES["inverter"]))
+                )
+                # the identity registers are read in one block, which also gives the throughput
+                known = self.warm.device(address)
+                channel.probe(lambda channel: len(channel.read_registers(3000, 2, 4)), known=known.get("baudrate"))
+                inverter = s5_inverter(channel, known_serial=known.get("serial"))
+                if inverter.responding:
+                    self.warm.remember(address, baudrate=channel.baudrate, serial=inverter.serial_number)
+                self.health[address] = DeviceHealth(f"Inverter {address}", online=inverter.responding)
+                self.poller.add(inverter, self._inverter_tiers(config), mandatory=(PRIO_CONTROL,))
+                self.inverters.append(inverter)
+            self.pv_power = 0  # W of all inverters
 
-            try:
-                self.boiler.check_device_type()
-            except Exception as e:
-                if self.boiler_is_optional:
-                    pass
-                else:
-                    raise e
+            # with several inverters each has its own service, this one shows their sum
+            self.units = {}  # s5_inverter: InverterUnit
+            if len(self.inverters) > 1:
+                portname = port.split("/")[-1]
+                for n, (address, inverter) in enumerate(zip(config["inverter_addresses"], self.inverters), 1):
+                    service = VeDbusService(f"com.victronenergy.pvinverter.{portname}_{address}")
+                    self.units[inverter] = InverterUnit(
+                        inverter,
+                        service,
+                        DbusPublisher(service, Deadbands),
+                        deviceinstance + 10 * n,
+                        f"Solis S5 ({address})",
+                        f"Modbus RTU on {port}, address {address}",
+                        self.warm.device(address),
+                    )
+
+            self.heaters = []
+            # the first heater is the boiler, at the address of the config file
+            self.heater_configs = [dict(HEATERS[0], address=config["boiler_address"])] + HEATERS[1:]
+            loads = []
+            for heater_config in self.heater_configs:
+                address = heater_config["address"]
+                channel = self.rs485.slave(
+                    address, SerialProfile(**SERIAL_PROFILES.get(address, SERIAL_PROFILES[SERVER_ADDRESS_BOILER]))
+                )
+                known = self.warm.device(address)
+                channel.probe(lambda channel: len(channel.read_registers(0, 5, 4)), known=known.get("baudrate"))
+                heater = WaterHeater(channel, heater_config["elements"], HEATER_READ_WRITE_MULTIPLE)
+                heater.target_temperature = heater_config.get("target_temperature", heater.target_temperature)
+
+                try:
+                    # a heater known from the cache gets a single read, a missing one is probed again later
+                    if known.get("baudrate"):
+                        heater.check_device_type(maxtries=1)
+                    else:
+                        heater.check_device_type()
+                    self.warm.remember(address, baudrate=channel.baudrate)
+                except Exception as e:
+                    # the heater is probed again while the service runs
+                    logging.warning(f"Water Heater {address} not found: {e}")
+                self.health[address] = DeviceHealth(f"Water Heater {address}", online=heater.connected)
+                self.heaters.append(heater)
+                loads.append(Load(heater, str(address), heater_config["priority"], heater_config["switch_time"]))
+            self.boiler = self.heaters[0]
+            # the controller decides the total power, the load manager splits it across the heaters
+            self.loads = LoadManager(loads)
+            self.controller = make_controller(config["controller"], self.loads.step_power, config["surplus_offset"])
 
             # Create the management objects, as specified in the ccgx dbus-api document
             self._dbusservice.add_path("/Mgmt/ProcessName", __file__)
@@ -118,12 +310,11 @@ class DbusPvBoilerService:
             self._dbusservice.add_path("/DeviceInstance", deviceinstance)
             self._dbusservice.add_path("/ProductId", self.boiler.Device_Type)
             self._dbusservice.add_path("/ProductName", productname)
-            self._dbusservice.add_path(
-                "/FirmwareVersion",
-                f"DSP:{self.inverter.read_dsp_version()}_LCD:{self.inverter.read_lcd_version()}",
-            )
-            self._dbusservice.add_path("/HardwareVersion", self.inverter.read_type())
-            self._dbusservice.add_path("/Connected", 1)
+            # the versions are read with the identity tier of the first polls, until then the known ones are shown
+            identity = self.warm.device(config["inverter_addresses"][0])
+            self._dbusservice.add_path("/FirmwareVersion", identity.get("/FirmwareVersion"))
+            self._dbusservice.add_path("/HardwareVersion", identity.get("/HardwareVersion"))
+            self._dbusservice.add_path("/Connected", 1 if self._inverters_connected() else 0)
 
             self._dbusservice.add_path(
                 "/Ac/Power",
@@ -235,6 +426,32 @@ class DbusPvBoilerService:
                 writeable=False,
                 gettextcallback=lambda a, x: "{:.0f}W".format(x),
             )
+            for path, name in (
+                ("/Heater/Energy/Today", "today"),
+                ("/Heater/Energy/Total", "total"),
+                ("/Heater/Energy/DivertedToday", "diverted_today"),
+                ("/Heater/Energy/DivertedTotal", "diverted_total"),
+            ):
+                self._dbusservice.add_path(
+                    path,
+                    self.energy.values[name],
+                    writeable=False,
+                    gettextcallback=lambda a, x: "{:.2f}kWh".format(x),
+                )
+            if len(self.heaters) > 1:
+                for heater_config in self.heater_configs:
+                    self._dbusservice.add_path(
+                        f"/Heater/{heater_config['address']}/Power",
+                        None,
+                        writeable=False,
+                        gettextcallback=lambda a, x: "{:.0f}W".format(x),
+                    )
+                    self._dbusservice.add_path(
+                        f"/Heater/{heater_config['address']}/Temperature",
+                        None,
+                        writeable=False,
+                        gettextcallback=lambda a, x: "{:.1f}°C".format(x),
+                    )
             self._dbusservice.add_path(
                 "/Heater/TargetTemperature",
                 None,
@@ -277,9 +494,12 @@ class DbusPvBoilerService:
 
             logging.info("Searching Gridmeter on VEBus")
             dummy = {"code": None, "whenToLog": "configChange", "accessLevel": None}
-            self.monitor = DbusMonitor({GRIDMETER_KEY_WORD: {"/Ac/Power": dummy}})
+            self.monitor = DbusMonitor(
+                {GRIDMETER_KEY_WORD: {"/Ac/Power": dummy}},
+                valueChangedCallback=self._on_grid_changed,
+            )
 
-            # changing settings in dbus-spy triggers a restart. is this intended?
+            # changed settings are applied in place, see _on_setting_changed
             self.settings = SettingsDevice(
                 bus=dbus.SystemBus()
                 if (platform.machine() == "armv7l")
@@ -293,20 +513,31 @@ class DbusPvBoilerService:
                     ],
                     "powerlimit": [
                         "/Settings/Heater/PowerLimit",
-                        self.inverter.rated_power,
+                        sum(inverter.rated_power for inverter in self.inverters),
                         0,
-                        self.inverter.rated_power,
+                        sum(inverter.rated_power for inverter in self.inverters),
                     ],
                 },  # 0 - use grid surplus only, 1-5999 - actual limit in W, 6000 - no limit
-                eventCallback=self._handlechangedvalue,
-            )
-            self.boiler.target_temperature = (
-                self.settings["targettemperature"] if not None else 50
+                eventCallback=self._on_setting_changed,
             )
+            self.boiler.target_temperature = min(self.settings["targettemperature"], 80)
+            self.publisher["/Heater/PowerLimit"] = self.settings["powerlimit"]
+
+            # from here on the serial port is used by the bus owner thread only
+            self.gridmeter_found = None
+            self.heater_target = 0
+            self.control_event = None  # timer() of the grid meter change a queued downstep reacts to
+            self.control_events = 0
+            self.reaction_times = deque(maxlen=REACTION_SAMPLES)
+            self._restore_control()
+            self.bus.start()
 
-            gobject.timeout_add(
-                LOOPTIME, self._update
-            )  # pause 1000ms before the next request
+            # keeps an absolute cadence of the loop time, independent of the callback duration
+            self.bus_overruns = 0
+            self.timer = CadenceTimer(config["looptime"], self._update)
+            self.timer.start()
+            if CONFIG_FILE is not None:
+                gobject.timeout_add_seconds(CONFIG_CHECK_INTERVAL, self._check_config)
 
         except RuntimeError:
             logging.warning("Critical Error, exiting")
@@ -320,25 +551,6 @@ class DbusPvBoilerService:
             )
             sys.exit(3)
 
-    def on_disconnect(self, client, userdata, rc):
-        if rc != 0:
-            logging.info("Unexpected MQTT disconnect. Will auto-reconnect")
-        try:
-            client.connect(self.broker_address)
-            self.is_connected = True
-        except Exception as e:
-            logging.error(
-                "Failed to Reconnect to " + self.broker_address + " " + str(e)
-            )
-            self.is_connected = False
-
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            logging.info("Connected to MQTT Broker " + self.broker_address)
-            self.is_connected = True
-        else:
-            logging.error("Failed to connect, return code %d\n", rc)
-
     def on_message(self, client, userdata, msg):
         try:
             self.is_online = True
@@ -347,112 +559,120 @@ class DbusPvBoilerService:
             logging.warning("Message parsing error " + str(e))
             print(e)
 
-    def _update(self):
-        start = timer()
+    def _on_history_request(self, client, userdata, msg):
+        # mqtt thread, the history is only touched in the main loop
         try:
-            # step 1: fetch energy data
-            # it seems very timecritical, so we can only read power and no other values.
-            # if we would, the grid power dbus readout gets spoiled ?!
-            self._dbusservice["/Ac/Power"] = power = self.inverter.read_active_power()
-            voltage = 230 # fake it, because we can't read it
-            current = power / voltage
-            #v1, c1 = self.inverter.read_phase(1) # as above - currently disabled, because bus is too slow at 9600
-            #v2, c2 = self.inverter.read_phase(2)
-            #v3, c3 = self.inverter.read_phase(3)
-            self._dbusservice["/Ac/Current"] = current # c1 + c2 + c3
-            self._dbusservice["/Ac/MaxPower"] = self.inverter.rated_power
-            self._dbusservice["/Ac/Energy/Forward"] = self.inverter.read_energy_total()
-            self._dbusservice["/Ac/L1/Voltage"] = voltage
-            self._dbusservice["/Ac/L2/Voltage"] = voltage
-            self._dbusservice["/Ac/L3/Voltage"] = voltage
-            self._dbusservice["/Ac/L1/Current"] = current / 3
-            self._dbusservice["/Ac/L2/Current"] = current / 3
-            self._dbusservice["/Ac/L3/Current"] = current / 3
-            self._dbusservice["/Ac/L1/Power"] = power / 3
-            self._dbusservice["/Ac/L2/Power"] = power / 3
-            self._dbusservice["/Ac/L3/Power"] = power / 3
-            self._dbusservice["/ErrorCode"] = 0  # TODO
-            self._dbusservice["/StatusCode"] = 0 # self.inverter.read_status()
+            request = json.loads(msg.payload.decode("utf-8") or "{}")
+        except ValueError as e:
+            logging.warning(f"Invalid history request: {e}")
+            return
+        gobject.idle_add(self._answer_history, request)
 
-        except Exception as e:
-            logging.info(
-                "WARNING: Could not read from Solis S5 Inverter",
-                exc_info=sys.exc_info()[0],
-            )
-            self._dbusservice["/Ac/Power"] = None
-            self._dbusservice["/Ac/Current"] = None
-            self._dbusservice["/Ac/MaxPower"] = None
-            self._dbusservice["/Ac/Energy/Forward"] = None
-            self._dbusservice["/Ac/L1/Voltage"] = None
-            self._dbusservice["/Ac/L2/Voltage"] = None
-            self._dbusservice["/Ac/L3/Voltage"] = None
-            self._dbusservice["/Ac/L1/Current"] = None
-            self._dbusservice["/Ac/L2/Current"] = None
-            self._dbusservice["/Ac/L3/Current"] = None
-            self._dbusservice["/Ac/L1/Power"] = None
-            self._dbusservice["/Ac/L2/Power"] = None
-            self._dbusservice["/Ac/L3/Power"] = None
-            self._dbusservice["/ErrorCode"] = None
-            self._dbusservice["/StatusCode"] = None
-            sys.exit(4)
-
-        # step 2: control boiler to use that energy
+    def _answer_history(self, request):
+        try:
+            records = self.history.query(
+                request.get("resolution", "1m"), request.get("start", 0), request.get("end")
+            )
+            response = {
+                "id": request.get("id"),
+                "fields": ["time", *HISTORY_FIELDS, "relays"],
+                # NaN is no json, missing values are null
+                "records": [[None if v != v else v for v in record] for record in records],
+            }
+        except (ValueError, TypeError) as e:
+            response = {"id": request.get("id"), "error": str(e)}
+        self.mqtt.send("historyresponse", json.dumps(response))
+        return False  # run once
+
+    def _update(self, late=False):
+        # runs in the main loop and never waits for the bus. reads and writes are queued
+        # to the bus owner thread, their results come back in the _on_*_done callbacks.
+        # in a late cycle only the control path and the mandatory reads are done
+        start = timer()
+        self.publisher.flush()  # stragglers that came in after the last telemetry cycle
+        if self.bus.is_pending("inverter"):
+            self.bus_overruns += 1  # the bus didn't finish the previous cycle's telemetry
+        # step 1: control boiler to use the surplus energy
+        # queued with control priority, so telemetry reads can never delay it
+        surplus = grid_power = None
         try:
             serviceNames = self.monitor.get_service_list(GRIDMETER_KEY_WORD)
-            if not serviceNames and not self.boiler_is_optional:
-                # in case we found no grid meter, exit
-                sys.exit(6)
+            if bool(serviceNames) != self.gridmeter_found:
+                # without a grid meter the heaters get no commands, their firmware turns them off
+                self.gridmeter_found = bool(serviceNames)
+                if serviceNames:
+                    logging.info("Found Gridmeter")
+                else:
+                    logging.warning("No Gridmeter found, the heaters are not controlled until there is one")
             for serviceName in serviceNames:
+                grid_power = self.monitor.get_value(serviceName, "/Ac/Power", 0)
                 # grid feed-in is counted negative. so we negate it to get the actual surplus value as positive number.
-                surplus = -self.monitor.get_value(serviceName, "/Ac/Power", 0) - SURPLUS_OFFSET
-                # print(f"surplus {surplus}")
-                self._dbusservice["/Heater/SurplusPower"] = surplus
-                self.boiler.operate(surplus + self.boiler.current_power) # target power is current surplus plus that what's currently burned
-
-            self._dbusservice["/Heater/Power"] = self.boiler.current_power
-            self._dbusservice["/Heater/Temperature"] = self.boiler.current_temperature
-            self._dbusservice[
-                "/Heater/TargetTemperature"
-            ] = self.boiler.target_temperature
-            # self._dbusservice["/ErrorCode"] = 0
-            # self._dbusservice["/StatusCode"] = self.boiler.status # is already written by inverter
+                self.publisher["/Heater/SurplusPower"] = surplus = -grid_power - self.config["surplus_offset"]
+                self._control(grid_power, self.pv_power, start)
+                self._submit_heater()
         except Exception as e:
-            try:
-                self._dbusservice["/Heater/Power"] = None
-                self._dbusservice["/Heater/Temperature"] = None
-                self._dbusservice["/ErrorCode"] = 5
-                self._dbusservice["/StatusCode"] = None
-            except Exception:
-                pass
-            logging.critical("Error in Water Heater", exc_info=sys.exc_info()[0])
-            if self.boiler_is_optional:
-                pass
-            else:
-                sys.exit(5)
+            # no bus transaction failed here, so it's not held against the heaters
+            logging.error("Error in the heater control", exc_info=e)
 
-        try:
-            self.client.publish(self.topics["pvpower"], power)
-            self.client.publish(self.topics["status"], self.boiler.status)
-            self.client.publish(self.topics["heaterpower"], self.boiler.current_power)
-            self.client.publish(
-                self.topics["heatertemperature"], self.boiler.current_temperature
-            )
-            self.client.publish(
-                self.topics["heatertargettemperature"], self.boiler.target_temperature
-            )
-            self.client.publish(self.topics["heartbeat"], self.boiler.heartbeat)
-        except Exception as e:
-            logging.warning(f"MQTT failure: {e}")
-            pass  #  mqtt is optional
+        self.history.add(
+            time(),
+            self.pv_power,
+            surplus,
+            self.loads.power if self.boiler.connected else None,
+            self.boiler.current_temperature if self.boiler.connected else None,
+            self.boiler.model.mask(self.boiler.cmd_bits),
+        )
+
+        self.energy.add(self.loads.power if self.boiler.connected else None, grid_power)
+        energy = self.energy.values
+        self.publisher["/Heater/Energy/Today"] = energy["today"]
+        self.publisher["/Heater/Energy/Total"] = energy["total"]
+        self.publisher["/Heater/Energy/DivertedToday"] = energy["diverted_today"]
+        self.publisher["/Heater/Energy/DivertedTotal"] = energy["diverted_total"]
+
+        if self.warm.due():
+            self.warm.save(self._control_snapshot())
+
+        # step 2: fetch energy data
+        # power is read every cycle, the other tiers when they are due and fit into the bus time budget.
+        # tiers read in the same cycle are merged into as few block reads as possible
+        deadline = start if late else start + self.config["bus_budget"] / 1000
+        # offline inverters are left out until their next probe is due
+        skip = [inverter for inverter in self.inverters if not self.health[inverter.bus.address].due(start)]
+        self.bus.submit(
+            BUS_PRIO_TELEMETRY,
+            "inverter",
+            lambda: self._inverter_job(deadline, skip),
+            lambda polled, error: self._on_inverter_done(polled, error, skip),
+        )
+
+        if late:
+            return True  # mqtt and statistics wait for the next cycle
+
+        self.mqtt.submit(
+            {
+                "pvpower": self.pv_power,
+                "status": self.boiler.status,
+                "heaterpower": self.loads.power,
+                "heatertemperature": self.boiler.current_temperature,
+                "heatertargettemperature": self.boiler.target_temperature,
+                "heartbeat": self.boiler.heartbeat,
+                "heaterenergytoday": round(energy["today"], 3),
+                "heaterenergytotal": round(energy["total"], 3),
+                "heaterdivertedtoday": round(energy["diverted_today"], 3),
+                "heaterdivertedtotal": round(energy["diverted_total"], 3),
+            }
+        )
+
+        self.statsCounter += 1
+        if self.statsCounter >= STATS_INTERVAL:
+            self.statsCounter = 0
+            self._publish_modbus_stats()
+            self._publish_loop_stats()
 
-        # increment UpdateIndex - to show that new data is available
-        self._dbusservice[path_UpdateIndex] = (
-            self._dbusservice[path_UpdateIndex] + 1
-        ) % 255  # increment index
-        
         end = timer()
         duration = end-start
-        if duration > LOOPTIME:
+        if duration > self.timer.period:
             self.logCounter += 1
             if self.logCounter < 1000:
                 logging.error(f"Loop duration longer then update interval: {duration:.3f}s")
@@ -461,6 +681,355 @@ class DbusPvBoilerService:
         # print(f"Duration: {duration:.3f}")
         return True
 
+    def _control_snapshot(self):
+        now = timer()
+        return {
+            "heater_target": self.heater_target,
+            "controller": {"name": self.controller.name, "state": self.controller.snapshot(now)},
+            "loads": self.loads.snapshot(now),
+            "heaters": {str(c["address"]): h.snapshot() for h, c in zip(self.heaters, self.heater_configs)},
+        }
+
+    def _restore_control(self):
+        # learned element powers are always taken back, the control state only after a short downtime
+        control = self.warm.resumable()
+        now = timer() - (self.warm.downtime() or 0)  # ages are counted from the snapshot
+        try:
+            heaters = self.warm.control.get("heaters", {})
+            for heater, heater_config in zip(self.heaters, self.heater_configs):
+                if str(heater_config["address"]) in heaters:
+                    heater.restore(heaters[str(heater_config["address"])], control is not None)
+            if control is None:
+                return
+            if control["controller"]["name"] == self.controller.name:
+                self.controller.restore(control["controller"]["state"], now)
+            self.loads.restore(control["loads"], now)
+            self.heater_target = control["heater_target"]
+            logging.info(f"Resuming the control after {self.warm.downtime():.0f}s, heater target {self.heater_target}W")
+        except (KeyError, TypeError, ValueError, IndexError) as e:
+            logging.warning(f"Control state not resumed: {e}")
+
+    @staticmethod
+    def _inverter_tiers(config):
+        return {
+            PRIO_CONTROL: 1,
+            PRIO_AC: config["ac_read_interval"],
+            PRIO_IDENTITY: config["identity_read_interval"],
+        }
+
+    @staticmethod
+    def _config_mtime():
+        try:
+            return os.stat(CONFIG_FILE).st_mtime
+        except (OSError, TypeError):
+            return None  # no file, the defaults apply
+
+    def _check_config(self):
+        # an edited, new or deleted config file is applied in place
+        mtime = self._config_mtime()
+        if mtime != self.config_mtime:
+            self.config_mtime = mtime
+            self._reload_config()
+        return True  # keep checking
+
+    def _reload_config(self):
+        """Read the config file and apply it, an invalid file leaves all settings as they are"""
+        try:
+            config = read_config()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Settings of {CONFIG_FILE} not applied: {e}")
+            return False
+        for name in changes(self.config, config) & set(RESTART_OPTIONS):
+            logging.warning(f"{name} changed to {config[name]}, this takes effect at the next start")
+            config[name] = self.config[name]
+        self._apply_config(config)
+        return True
+
+    def _apply_config(self, config):
+        """Switch to a validated config, built from scratch where needed and swapped as a whole"""
+        changed = changes(self.config, config)
+        if not changed:
+            return
+        now = timer()
+        controller = self.controller
+        if changed & {"controller", "surplus_offset"}:
+            # a controller of the same kind carries on with the state of the old one
+            controller = make_controller(config["controller"], self.loads.step_power, config["surplus_offset"])
+            if controller.name == self.controller.name:
+                controller.restore(self.controller.snapshot(now), now)
+
+        old, self.config = self.config, config
+        self.controller = controller
+        self.boiler_is_optional = config["boiler_is_optional"]
+        self.timer.period = config["looptime"] / 1000
+        if changed & {"bus_budget", "ac_read_interval", "identity_read_interval"}:
+            # the scheduler belongs to the bus thread, it's re-planned between two polls.
+            # not at control priority, that would run it from within a poll with run_urgent.
+            # a change while the job waits isn't queued again, the job takes the latest config
+            self.bus.submit(BUS_PRIO_BACKGROUND, "replan", self._replan)
+        if changed & {"broker_address", "topics", "mqtt_mode", "mqtt_max_age"}:
+            topics = config["topics"]
+            if topics["historyrequest"] != old["topics"]["historyrequest"]:
+                self.client.message_callback_remove(old["topics"]["historyrequest"])
+                self.client.message_callback_add(topics["historyrequest"], self._on_history_request)
+            self.mqtt.reconfigure(
+                topics,
+                config["mqtt_mode"],
+                config["mqtt_max_age"],
+                config["broker_address"],
+                topics["status"],
+                [topics["historyrequest"]],
+            )
+        logging.info(f"Settings changed: {', '.join(sorted(changed))}")
+
+    def _replan(self):
+        config = self.config
+        self.poller.budget = config["bus_budget"] / 1000
+        for inverter in self.inverters:
+            self.poller.retier(inverter, self._inverter_tiers(config))
+
+    def _control(self, grid_power, pv_power, now):
+        # the controller returns None to keep the current stage, the last request stays the heater's target
+        request = self.controller.update(grid_power, self.loads.power, pv_power, now)
+        if request is not None:
+            self.heater_target = request
+        return request
+
+    def _submit_heater(self):
+        # offline heaters are left alone until their next probe is due
+        now = timer()
+        probe = [h for h in self.heaters if not h.connected and self.health[h.instrument.address].due(now)]
+        self.bus.submit(BUS_PRIO_CONTROL, "heater", lambda: self._heater_job(probe), self._on_heater_done)
+
+    def _heater_job(self, probe):
+        # runs on the bus and takes the latest target if the job had to wait.
+        # the event is read first, a target set together with it is then seen as well.
+        # returns the event and the served heaters with their error, None if it went well
+        event = self.control_event
+        served = []
+        for heater, power in self.loads.apply(self.heater_target, timer()):
+            try:
+                if heater in probe:
+                    heater.check_device_type(maxtries=1)
+                elif not heater.connected:
+                    continue
+                heater.operate(power)
+                served.append((heater, None if heater.responding else "no valid response"))
+            except Exception as e:
+                served.append((heater, e))
+        return event, served
+
+    def _on_grid_changed(self, service, path, options, changes, deviceinstance):
+        # the grid meter signals every change, so an import is handled right away instead of
+        # in the next cycle. the controller's switching rules apply as in the cycle, mostly
+        # this means downsteps: an upstep has to wait for the switching interval anyway
+        value = changes.get("Value")
+        if path != "/Ac/Power" or value is None or not service.startswith(GRIDMETER_KEY_WORD):
+            return
+        request = self._control(value, None, timer())  # no new pv reading
+        if request is None or self.loads.step_power(request) == self.loads.commanded:
+            return  # the heaters are already at the stages for it
+        self.publisher["/Heater/SurplusPower"] = -value - self.config["surplus_offset"]
+        if self.control_event is None:
+            self.control_event = timer()  # a pending downstep serves this change too, measure from the first one
+        self.control_events += 1
+        self._submit_heater()
+
+    def _on_heater_done(self, result, error):
+        now = timer()
+        if error is not None:
+            logging.error("Error in Water Heater control", exc_info=error)
+            event, served = None, [(heater, error) for heater in self.heaters if heater.connected]
+        else:
+            event, served = result
+        for heater, failure in served:
+            health = self.health[heater.instrument.address]
+            if failure is None:
+                health.success()
+            else:
+                health.failure(now, failure)
+                if not health.connected:
+                    heater.connected = False  # out of the allocation until a probe finds it again
+        if event is not None:
+            # reaction time from the grid meter change to the acknowledged relay command
+            command_time = max((h.command_time for h in self.heaters if h.command_time is not None), default=None)
+            if all(failure is None for _, failure in served) and command_time is not None and command_time >= event:
+                self.reaction_times.append(command_time - event)
+            if self.control_event == event:
+                self.control_event = None
+
+        valid = {heater: self.health[heater.instrument.address].valid for heater in self.heaters}
+        self.publisher["/Heater/Power"] = self.loads.power if any(valid.values()) else None
+        self.publisher["/Heater/Temperature"] = self.boiler.current_temperature if valid[self.boiler] else None
+        if len(self.heaters) > 1:
+            for heater, heater_config in zip(self.heaters, self.heater_configs):
+                address = heater_config["address"]
+                self.publisher[f"/Heater/{address}/Power"] = heater.current_power if valid[heater] else None
+                self.publisher[f"/Heater/{address}/Temperature"] = heater.current_temperature if valid[heater] else None
+        self.publisher["/Heater/TargetTemperature"] = self.boiler.target_temperature
+        self.publisher["/ErrorCode"] = self._error_code()
+
+    def _inverters_connected(self):
+        return any(self.health[inverter.bus.address].connected for inverter in self.inverters)
+
+    def _error_code(self):
+        # the codes the service used to exit with: 4 inverter, 5 heater, 6 grid meter
+        if not all(self.health[inverter.bus.address].connected for inverter in self.inverters):
+            return 4
+        if not self.boiler_is_optional:
+            if not all(self.health[heater.instrument.address].connected for heater in self.heaters):
+                return 5
+            if self.gridmeter_found is False:
+                return 6
+        return 0
+
+    def _inverter_job(self, deadline, skip):
+        # an inverter that didn't answer at startup is identified before its poll.
+        # the poll errors are taken here, the next job may start before the results are handled
+        for inverter in self.inverters:
+            if inverter not in skip and not inverter.serial_number:
+                inverter.identify()
+        return [(device, priorities, device.poll_error) for device, priorities in self.poller.run(deadline, skip)]
+
+    def _on_inverter_done(self, polled, error, skip=()):
+        # every served inverter gets a result, a failed job counts as a failure of all of them
+        now = timer()
+        if error is not None:
+            logging.info("WARNING: Could not read from Solis S5 Inverter", exc_info=error)
+        errors = {device: poll_error for device, _, poll_error in polled or []}
+        polled = {device: priorities for device, priorities, _ in polled or []}
+        for inverter in self.inverters:
+            if inverter in skip:
+                continue
+            address = inverter.bus.address
+            health = self.health[address]
+            failure = error or errors.get(inverter, "not polled")
+            if failure is None:
+                health.success()
+                if inverter.serial_number:
+                    self.warm.remember(address, baudrate=inverter.bus.baudrate, serial=inverter.serial_number)
+            else:
+                health.failure(now, failure)
+
+        valid = [inverter for inverter in self.inverters if self.health[inverter.bus.address].valid]
+        total = total_ac_values(valid)
+        for path, value in total.items():
+            self.publisher[path] = value
+        self.pv_power = total["/Ac/Power"] or 0
+        for device, priorities in polled.items():
+            if PRIO_IDENTITY in priorities and device in valid:
+                identity = identity_values(device)
+                self.warm.remember(device.bus.address, **identity)
+                if device is self.inverters[0]:
+                    for path, value in identity.items():
+                        self.publisher[path] = value
+        for inverter, unit in self.units.items():
+            if inverter not in skip:
+                unit.publish(polled.get(inverter, ()), self.health[inverter.bus.address])
+        self.publisher["/Connected"] = 1 if self._inverters_connected() else 0
+        self.publisher["/ErrorCode"] = self._error_code()
+        self.publisher["/StatusCode"] = 0 if valid else None  # self.inverter.read_status()
+
+        # increment UpdateIndex - to show that new data is available
+        self.publisher[path_UpdateIndex] = (
+            self.publisher[path_UpdateIndex] + 1
+        ) % 255  # increment index
+        # everything written in this cycle goes out in one batch
+        self.publisher.flush()
+
+    def _publish_modbus_stats(self):
+        # per slave and per register block transaction statistics of the last STATS WINDOW
+        stats = {}
+        for address, channel in self.rs485.slaves.items():
+            summary = channel.stats.summary()
+            blocks = {label: s.summary() for label, s in list(channel.block_stats.items())}
+            stats[address] = {"counters": dict(channel.counters), "window": summary, "blocks": blocks}
+
+            prefix = f"/Debug/Modbus/{address}"
+            health = self.health.get(address)
+            if health is not None:
+                stats[address]["health"] = health.state
+                self._set_debug_path(f"{prefix}/Health", health.state)
+                self._set_debug_path(f"{prefix}/Recoveries", health.recoveries)
+            self._set_debug_path(f"{prefix}/Requests", channel.counters["requests"])
+            self._set_debug_path(f"{prefix}/Timeouts", channel.counters["timeout"])
+            self._set_debug_path(f"{prefix}/CrcErrors", channel.counters["crc"])
+            self._set_debug_path(f"{prefix}/InvalidResponses", channel.counters["invalid"])
+            self._set_debug_path(f"{prefix}/IllegalRequests", channel.counters["illegal"])
+            self._set_debug_path(f"{prefix}/ErrorRate", summary["error_rate"], "{:.1f}%")
+            self._set_debug_path(f"{prefix}/LatencyP50", summary["latency_p50"], "{:.1f}ms")
+            self._set_debug_path(f"{prefix}/LatencyP99", summary["latency_p99"], "{:.1f}ms")
+            self._set_debug_path(f"{prefix}/LostTime", summary["lost_time"], "{:.1f}%")
+            self._set_debug_path(f"{prefix}/Timeout", round(channel.timeout * 1000, 1), "{:.1f}ms")
+            self._set_debug_path(f"{prefix}/Profile", channel.describe())
+            self._set_debug_path(
+                f"{prefix}/Throughput", None if channel.throughput is None else round(channel.throughput), "{:.0f}B/s"
+            )
+            self._set_debug_path(f"{prefix}/Fallbacks", channel.fallbacks)
+            stats[address]["timeout"] = channel.timeout
+            stats[address]["profile"] = channel.describe()
+            stats[address]["throughput"] = channel.throughput
+            for label, block in blocks.items():
+                block["timeout"] = channel.block_timeout(label)
+                self._set_debug_path(f"{prefix}/{label}/ErrorRate", block["error_rate"], "{:.1f}%")
+                self._set_debug_path(f"{prefix}/{label}/LatencyP99", block["latency_p99"], "{:.1f}ms")
+                self._set_debug_path(f"{prefix}/{label}/Timeout", round(block["timeout"] * 1000, 1), "{:.1f}ms")
+
+        self.mqtt.send("modbusstats", json.dumps(stats))
+
+    def _publish_loop_stats(self):
+        summary = self.timer.summary()
+        self._set_debug_path("/Debug/Loop/Cycles", summary["cycles"])
+        self._set_debug_path("/Debug/Loop/LateCycles", summary["late"])
+        self._set_debug_path("/Debug/Loop/Overruns", summary["overruns"])
+        self._set_debug_path("/Debug/Loop/SkippedCycles", summary["skipped"])
+        self._set_debug_path("/Debug/Loop/BusOverruns", self.bus_overruns)
+        self._set_debug_path("/Debug/Loop/JitterP50", summary["jitter_p50"], "{:.1f}ms")
+        self._set_debug_path("/Debug/Loop/JitterP99", summary["jitter_p99"], "{:.1f}ms")
+        self._set_debug_path("/Debug/Loop/JitterMax", summary["jitter_max"], "{:.1f}ms")
+        self._set_debug_path("/Debug/Loop/MaxDuration", summary["max_duration"], "{:.1f}ms")
+        reactions = sorted(self.reaction_times)
+        self._set_debug_path("/Debug/Control/Events", self.control_events)
+        self._set_debug_path(
+            "/Debug/Control/ReactionTime",
+            round(self.reaction_times[-1] * 1000, 1) if reactions else None,
+            "{:.1f}ms",
+        )
+        self._set_debug_path(
+            "/Debug/Control/ReactionTimeP50",
+            round(percentile(reactions, 50) * 1000, 1) if reactions else None,
+            "{:.1f}ms",
+        )
+        self._set_debug_path(
+            "/Debug/Control/ReactionTimeP99",
+            round(percentile(reactions, 99) * 1000, 1) if reactions else None,
+            "{:.1f}ms",
+        )
+        for n, power in enumerate(self.boiler.model.estimates):
+            self._set_debug_path(f"/Debug/Heater/Element{n}/Power", round(power), "{:.0f}W")
+        self._set_debug_path("/Debug/Dbus/PublishedUpdates", self.publisher.published)
+        self._set_debug_path("/Debug/Dbus/SuppressedUpdates", self.publisher.suppressed)
+        self._set_debug_path("/Debug/Dbus/Batches", self.publisher.batches)
+        age = self.mqtt.seconds_since_publish()
+        self._set_debug_path("/Debug/Mqtt/State", self.mqtt_connection.state)
+        self._set_debug_path(
+            "/Debug/Mqtt/SecondsSinceLastPublish", None if age is None else round(age, 1), "{:.1f}s"
+        )
+        self._set_debug_path("/Debug/Mqtt/Published", self.mqtt.published)
+        self._set_debug_path("/Debug/Mqtt/Dropped", self.mqtt.dropped)
+        self._set_debug_path("/Debug/Mqtt/Buffered", len(self.mqtt.buffer))
+        self._set_debug_path("/Debug/Mqtt/Replayed", self.mqtt.replayed)
+
+    def _set_debug_path(self, path, value, text="{}"):
+        # debug paths are created when they get their first value, register blocks are only known then
+        if path not in self._debug_paths:
+            self._dbusservice.add_path(
+                path, value, gettextcallback=lambda a, x: "" if x is None else text.format(x)
+            )
+            self._debug_paths.add(path)
+        else:
+            self.publisher[path] = value
+
     def _handlechangedvalue(self, path, value):
         logging.info("someone else updated %s to %s" % (path, value))
         if path == "/Heater/TargetTemperature":
@@ -468,6 +1037,15 @@ class DbusPvBoilerService:
             return True  # accept the change
         return False
 
+    def _on_setting_changed(self, setting, old, new):
+        # called by SettingsDevice with the setting's name, not its path
+        logging.info(f"Setting {setting} changed from {old} to {new}")
+        if setting == "targettemperature":
+            self.boiler.target_temperature = min(new, 80)
+            self.publisher["/Heater/TargetTemperature"] = self.boiler.target_temperature
+        elif setting == "powerlimit":
+            self.publisher["/Heater/PowerLimit"] = new
+
 
 def main():
     thread.daemon = True  # allow the program to quit
@@ -486,6 +1064,12 @@ def main():
     try:
         logging.info("+++++ Start PV Boiler modbus service v" + str(VERSION))
 
+        try:
+            config = read_config()
+        except (OSError, ValueError) as e:
+            logging.error(f"Settings of {CONFIG_FILE} not used: {e}")
+            config = default_config()
+
         if len(sys.argv) > 1:
             port = sys.argv[1]
         else:
@@ -499,13 +1083,15 @@ def main():
 
         portname = port.split("/")[-1]
         portnumber = int(portname[-1]) if portname[-1].isdigit() else 0
+        # with several inverters each one is a pvinverter service, the system would count
+        # their sum twice if this service was one too
+        servicetype = "pvinverter" if len(config["inverter_addresses"]) == 1 else "pvboiler"
         pvac_output = DbusPvBoilerService(
             port=port,
-            servicename="com.victronenergy.pvinverter." + portname,
+            servicename=f"com.victronenergy.{servicetype}." + portname,
             deviceinstance=288 + portnumber,
             connection="Modbus RTU on " + port,
-            topics=Topics,
-            broker_address=Broker_Address,
+            config=config,
         )
 
         logging.info(
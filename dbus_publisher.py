@@ -0,0 +1,72 @@
+"""
+Change driven, batched publication of values on a VeDbusService
+
+Every item write on a VeDbusService emits a PropertiesChanged signal, even if the
+value didn't change. DbusPublisher collects the writes of a cycle, drops those within
+the path's deadband of the last published value and sends the rest in one batch.
+With a velib_python that supports it (VeDbusService used as context manager) the batch
+goes out as a single ItemsChanged signal, with older versions item by item.
+
+Deadbands are given per path pattern (fnmatch) as (absolute, relative), a change is
+published if it is larger than max(absolute, relative * |last published value|).
+Paths without a deadband are published on every change.
+"""
+from fnmatch import fnmatch
+
+_MISSING = object()
+
+
+class DbusPublisher:
+    def __init__(self, service, deadbands=None):
+        self.service = service
+        self.deadbands = deadbands or {}
+        self._bands = {}  # path: resolved deadband
+        self._published = {}  # path: last published value
+        self.pending = {}
+        self.published = 0
+        self.suppressed = 0
+        self.batches = 0
+        self._batched = hasattr(service, "__enter__")
+
+    def _band(self, path):
+        if path not in self._bands:
+            self._bands[path] = next(
+                (band for pattern, band in self.deadbands.items() if fnmatch(path, pattern)),
+                (0, 0),
+            )
+        return self._bands[path]
+
+    def _changed(self, path, value):
+        old = self._published.get(path, _MISSING)
+        if old is _MISSING:
+            return True
+        if old is None or value is None or isinstance(value, str) or isinstance(old, str):
+            return old != value
+        absolute, relative = self._band(path)
+        return abs(value - old) > max(absolute, relative * abs(old))
+
+    def __getitem__(self, path):
+        value = self.pending.get(path, _MISSING)
+        return self.service[path] if value is _MISSING else value
+
+    def __setitem__(self, path, value):
+        if self._changed(path, value):
+            self.pending[path] = value
+        else:
+            self.pending.pop(path, None)  # a change and its return in the same cycle
+            self.suppressed += 1
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self._batched:
+            with self.service as batch:
+                for path, value in self.pending.items():
+                    batch[path] = value
+        else:
+            for path, value in self.pending.items():
+                self.service[path] = value
+        self._published.update(self.pending)
+        self.published += len(self.pending)
+        self.batches += 1
+        self.pending.clear()
@@ -0,0 +1,82 @@
+"""
+Health of a modbus slave, so a bus fault never ends the service
+
+    online -> degraded -> offline -> probing -> online
+                 |           ^          |
+                 +-> online  +----------+
+
+A failed cycle makes a device degraded: its values are invalid for that cycle, but it
+still counts as connected and is served every cycle, so a single bad frame is over
+with the next good one. After offline_after failed cycles in a row it is offline,
+shown as disconnected and left out of the polls. It is probed again after a backoff
+that doubles from backoff_min up to backoff_max s, a failed probe waits longer.
+One good cycle brings a device back online from any state.
+
+The state is changed in the main loop only, from the results of the bus jobs.
+"""
+import logging
+
+ONLINE = "online"
+DEGRADED = "degraded"
+OFFLINE = "offline"
+PROBING = "probing"
+
+OFFLINE_AFTER = 3  # failed cycles in a row
+BACKOFF_MIN = 2  # s to the first probe of an offline device
+BACKOFF_MAX = 60  # s between probes, e.g. of an inverter at night
+
+
+class DeviceHealth:
+    def __init__(self, name, online=True, offline_after=OFFLINE_AFTER, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        """online=False for a device that wasn't found at startup, it is probed from the start"""
+        self.name = name
+        self.offline_after = offline_after
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.state = ONLINE if online else OFFLINE
+        self.failures = 0  # failed cycles in a row
+        self.delay = backoff_min
+        self.next_probe = float("-inf")
+        self.recoveries = 0
+        self.last_error = None
+
+    @property
+    def valid(self):
+        """True if the last cycle delivered values"""
+        return self.state == ONLINE
+
+    @property
+    def connected(self):
+        return self.state in (ONLINE, DEGRADED)
+
+    def due(self, now):
+        """True if the device is to be served now, an offline device only when a probe is due"""
+        if self.state != OFFLINE:
+            return True
+        if now < self.next_probe:
+            return False
+        self.state = PROBING
+        return True
+
+    def success(self):
+        if self.state != ONLINE:
+            if self.state != DEGRADED:
+                logging.info(f"{self.name} is back online")
+            self.recoveries += 1
+        self.state = ONLINE
+        self.failures = 0
+        self.delay = self.backoff_min
+
+    def failure(self, now, error=None):
+        self.failures += 1
+        self.last_error = error
+        if self.state == OFFLINE:
+            return  # from a cycle that started before, it doesn't delay the next probe
+        if self.state == PROBING or self.failures >= self.offline_after:
+            if self.state in (ONLINE, DEGRADED):
+                logging.warning(f"{self.name} is offline after {self.failures} failed cycles: {error}")
+            self.state = OFFLINE
+            self.next_probe = now + self.delay
+            self.delay = min(self.delay * 2, self.backoff_max)
+        else:
+            self.state = DEGRADED
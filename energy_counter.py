@@ -0,0 +1,92 @@
+"""
+Energy counters of the heater
+
+The heater power is integrated every update cycle into today and total kWh, together
+with the part of it that was diverted PV surplus: heater power minus the grid import
+of the same moment, the rest came from the grid.
+
+Power between two samples is taken as their average (trapezoid). An interval longer
+than max_gap s is not integrated, nobody knows what the heater did while the driver
+was stopped or the bus was down, it is counted in gaps instead.
+The time step comes from a monotonic clock, so clock changes don't count as energy.
+Today is reset at local midnight.
+
+The counters are saved as JSON every save_interval s and at midnight, written to a
+temporary file and renamed, so a power cut leaves either the old or the new file.
+"""
+import json
+import logging
+import os
+from datetime import date
+from time import monotonic
+
+COUNTERS = ("today", "total", "diverted_today", "diverted_total")  # kWh
+MAX_GAP = 10  # s
+SAVE_INTERVAL = 600  # s
+
+
+class EnergyCounter:
+    def __init__(self, filename, max_gap=MAX_GAP, save_interval=SAVE_INTERVAL):
+        self.filename = filename
+        self.max_gap = max_gap
+        self.save_interval = save_interval
+        self.values = dict.fromkeys(COUNTERS, 0.0)
+        self.day = date.today().isoformat()
+        self.gaps = 0
+        self.last = None  # (monotonic time, heater W, diverted W)
+        self.last_save = monotonic()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            for name in COUNTERS:
+                self.values[name] = float(saved.get(name, 0.0))
+            if saved.get("day") != self.day:
+                self.values["today"] = self.values["diverted_today"] = 0.0
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.warning(f"Energy counters not loaded from {self.filename}: {e}")
+
+    def save(self):
+        self.last_save = monotonic()
+        temporary = self.filename + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(dict(self.values, day=self.day), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            logging.warning(f"Energy counters not saved to {self.filename}: {e}")
+
+    def add(self, heater_power, grid_power, now=None):
+        """Integrate one sample, heater_power None if unknown, grid_power import positive"""
+        now = monotonic() if now is None else now
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.values["today"] = self.values["diverted_today"] = 0.0
+            self.save()
+
+        if heater_power is None:
+            self.last = None
+            return
+        diverted = max(0.0, heater_power - max(0.0, grid_power or 0.0))
+        if self.last is not None:
+            dt = now - self.last[0]
+            if dt > self.max_gap:
+                self.gaps += 1
+            elif dt > 0:
+                heater_kwh = (heater_power + self.last[1]) / 2 * dt / 3.6e6
+                diverted_kwh = (diverted + self.last[2]) / 2 * dt / 3.6e6
+                self.values["today"] += heater_kwh
+                self.values["total"] += heater_kwh
+                self.values["diverted_today"] += diverted_kwh
+                self.values["diverted_total"] += diverted_kwh
+        self.last = (now, heater_power, diverted)
+
+        if now - self.last_save >= self.save_interval:
+            self.save()
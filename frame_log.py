@@ -0,0 +1,220 @@
+"""
+Recording and replay of the raw modbus frames on the RS485 port
+
+RecordingSerial sits between minimalmodbus and the pyserial port and writes every
+request, every response (also a short or empty one, that is a timeout) and every
+change of the line settings to a FrameLog. A log file is
+
+    header      magic, version, unix time of the file start
+    records     µs since the previous record, kind, length, bytes
+
+so a frame costs 7 bytes on top of its own. The time step comes from a monotonic clock.
+When a file reaches max_size it is renamed to <file>.1, replacing the one before,
+and a new file is started: the log never takes more than twice max_size.
+
+ReplaySerial plays a log back to the same code: a written request is answered with
+the response recorded for it, as fast as possible or with the recorded response
+times. A request is matched to the next recorded one with the same bytes, else the
+same slave, function and start register (a heartbeat value differs every time),
+within MATCH_WINDOW requests. A request without a match wasn't sent in the recorded
+run, it is answered with a timeout. The replay counts requests that weren't identical
+and those without a match. At the end of the log ReplayEnd is raised.
+"""
+import logging
+import os
+import struct
+import time
+from time import monotonic, sleep
+
+FILE_HEADER = struct.Struct("<4sHd")  # magic, version, unix time of the file start
+RECORD = struct.Struct("<IBH")  # µs since the previous record, kind, length
+LINE = struct.Struct("<Ic")  # baud rate, parity
+MAGIC = b"PVBF"
+FILE_VERSION = 1
+
+TX, RX, LINE_SETTINGS = 0, 1, 2  # record kinds
+MAX_SIZE = 4 * 1024 * 1024  # bytes per file
+FLUSH_INTERVAL = 1  # s
+MATCH_WINDOW = 20  # recorded requests searched for the one matching a replayed request
+
+
+class ReplayEnd(Exception):
+    """The replayed log has no more frames"""
+
+
+class FrameLog:
+    def __init__(self, filename, max_size=MAX_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.filename = filename
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.file = None
+        self.frames = 0
+        self.rotations = 0
+        self._open()
+
+    def _open(self):
+        self.file = open(self.filename, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, FILE_VERSION, time.time()))
+        self.size = FILE_HEADER.size
+        self.last = monotonic()
+        self.last_flush = self.last
+
+    def _rotate(self):
+        self.file.close()
+        os.replace(self.filename, self.filename + ".1")
+        self.rotations += 1
+        self._open()
+
+    def add(self, kind, data):
+        now = monotonic()
+        if self.size + RECORD.size + len(data) > self.max_size:
+            self._rotate()
+        delta = min(int((now - self.last) * 1e6), 0xFFFFFFFF)
+        self.file.write(RECORD.pack(delta, kind, len(data)))
+        self.file.write(data)
+        self.size += RECORD.size + len(data)
+        self.last = now
+        self.frames += 1
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = monotonic()
+        try:
+            self.file.flush()
+        except OSError as e:
+            logging.warning(f"Frame log flush failed: {e}")
+
+    def close(self):
+        self.file.close()
+
+
+def read_frames(filename):
+    """Records of a log file as (s since the file start, kind, bytes)"""
+    with open(filename, "rb") as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[:2] != (MAGIC, FILE_VERSION):
+            raise ValueError(f"{filename} is no frame log")
+        t = 0.0
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return  # end, or a record cut off by a power loss
+            delta, kind, length = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            t += delta / 1e6
+            yield t, kind, data
+
+
+class RecordingSerial:
+    """Wrapper of a pyserial port recording what is written and read"""
+
+    def __init__(self, serial, log):
+        object.__setattr__(self, "_serial", serial)
+        object.__setattr__(self, "_log", log)
+        object.__setattr__(self, "_line", None)
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._serial, name, value)
+
+    def write(self, data):
+        line = (self._serial.baudrate, self._serial.parity)
+        if line != self._line:
+            object.__setattr__(self, "_line", line)
+            self._log.add(LINE_SETTINGS, LINE.pack(line[0], line[1].encode()))
+        self._log.add(TX, bytes(data))
+        return self._serial.write(data)
+
+    def read(self, size=1):
+        data = self._serial.read(size)
+        self._log.add(RX, data)
+        return data
+
+
+class ReplaySerial:
+    """Serial port look-alike answering from recorded frame logs
+
+    realtime waits the recorded response time before a response is returned.
+    """
+
+    def __init__(self, filenames, realtime=False):
+        self.port = None
+        self.is_open = True
+        self.baudrate = 9600
+        self.parity = "N"
+        self.bytesize = 8
+        self.stopbits = 1
+        self.timeout = 0.05
+        self.realtime = realtime
+        self.frames = [frame for filename in filenames for frame in read_frames(filename)]
+        self.tx_frames = [i for i, (_, kind, _) in enumerate(self.frames) if kind == TX]
+        self.next_request = 0  # index into tx_frames, the first recorded request not used yet
+        self.position = 0
+        self.requests = 0
+        self.mismatches = 0  # requests that differ from the recorded ones
+        self.unmatched = 0  # requests not in the recording, answered with a timeout
+        self.answering = False  # False while the latest request has no recorded response
+        self.line_changes = 0
+        self.sent = None  # (monotonic time, recorded time) of the latest request
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    @property
+    def finished(self):
+        return self.next_request >= len(self.tx_frames)
+
+    def _match(self, data):
+        candidates = self.tx_frames[self.next_request : self.next_request + MATCH_WINDOW]
+        for same in (lambda recorded: recorded == data, lambda recorded: recorded[:4] == data[:4]):
+            for n, index in enumerate(candidates):
+                if same(self.frames[index][2]):
+                    return self.next_request + n
+        return None
+
+    def write(self, data):
+        if self.finished:
+            raise ReplayEnd(f"replayed {self.requests} requests")
+        data = bytes(data)
+        self.requests += 1
+        match = self._match(data)
+        self.answering = match is not None
+        if match is None:
+            self.unmatched += 1
+            return len(data)
+        self.next_request = match + 1
+        index = self.tx_frames[self.next_request - 1]
+        self.line_changes += sum(kind == LINE_SETTINGS for _, kind, _ in self.frames[self.position : index])
+        # frames in between weren't needed in this run, e.g. a resync after a recorded timeout
+        recorded_time, _, recorded = self.frames[index]
+        self.position = index + 1
+        if data != recorded:
+            self.mismatches += 1
+        self.sent = (monotonic(), recorded_time)
+        return len(data)
+
+    def read(self, size=1):
+        if not self.answering or self.position >= len(self.frames) or self.frames[self.position][1] != RX:
+            return b""  # the recorded run didn't read here, as after a timeout
+        recorded_time, _, data = self.frames[self.position]
+        self.position += 1
+        if self.realtime and self.sent is not None:
+            sleep(max(0.0, self.sent[0] + recorded_time - self.sent[1] - monotonic()))
+        return data[:size]
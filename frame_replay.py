@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Replay of a recorded modbus frame log through the inverter and heater drivers
+
+A log recorded with FRAME_LOG_FILE of the service (or any FrameLog) is answered by
+ReplaySerial while s5_inverter and WaterHeater run their usual startup and update
+cycle against it, through the same Rs485Port transport. So a field capture of a bus
+problem becomes an offline test: it shows how the drivers and the transport handle
+exactly that sequence of frames, timeouts and garbled responses.
+
+The heater is commanded the relays the recorded run wrote, taken from its coil writes
+(or the relay mask of a function 23 write) ahead in the log, so the replay sends the
+same requests the field did.
+
+By default the frames are replayed as fast as possible, with --realtime the recorded
+response times are kept, which also makes the timeout handling behave as in the field.
+
+    python frame_replay.py frames.bin.1 frames.bin --realtime --output replay.json
+"""
+import argparse
+import json
+import logging
+import struct
+from time import monotonic
+
+from frame_log import MATCH_WINDOW, ReplayEnd, ReplaySerial
+from rs485_transport import Rs485Port, SerialProfile
+from solis_s5_inverter import s5_inverter, PRIO_CONTROL, PRIO_AC, PRIO_IDENTITY
+from water_heater import WaterHeater
+
+REPLAY_PORT = "replay"  # port name the replay serial is registered under
+
+
+def recorded_relays(serial, address, mask):
+    """Relay mask the recorded run wrote to the heater in its next cycle, mask if it kept the relays"""
+    for index in serial.tx_frames[serial.next_request : serial.next_request + MATCH_WINDOW]:
+        frame = serial.frames[index][2]
+        if len(frame) < 8 or frame[0] != address:
+            continue
+        function, start = frame[1], struct.unpack(">H", frame[2:4])[0]
+        if function == 15 and start == 0:
+            # write_bits from Power_500W: start, count, byte count, coil bytes
+            return int.from_bytes(frame[7 : 7 + frame[6]], "little")
+        if function == 23 and len(frame) >= 17:
+            # read start, count, write start, count, byte count, heartbeat, relay mask
+            return struct.unpack(">H", frame[13:15])[0]
+        if function == 16 and start == 0:
+            return mask  # a heartbeat without a coil write before it
+    return mask
+
+
+def run(serial, inverter_address, boiler_address, identity_interval):
+    port = Rs485Port(REPLAY_PORT, serial=serial)
+    inverter_channel = port.slave(inverter_address, SerialProfile())
+    boiler_channel = port.slave(boiler_address, SerialProfile())
+    inverter = boiler = None
+    start = monotonic()
+    cycles = 0
+    try:
+        # the startup of the service, in its order
+        inverter_channel.probe(lambda channel: len(channel.read_registers(3000, 2, 4)))
+        inverter = s5_inverter(inverter_channel)
+        boiler_channel.probe(lambda channel: len(channel.read_registers(0, 5, 4)))
+        boiler = WaterHeater(boiler_channel)
+        boiler.check_device_type()
+        while not serial.finished:
+            next_request = serial.next_request
+            # the heater first, its job goes ahead of the inverter poll on the service's bus
+            mask = recorded_relays(serial, boiler_address, boiler.model.mask(boiler.cmd_bits))
+            boiler.operate(boiler.model.request(boiler.model.commands[mask]))
+            priorities = (PRIO_CONTROL, PRIO_AC)
+            if cycles % identity_interval == 0:
+                priorities += (PRIO_IDENTITY,)
+            inverter.poll(priorities)
+            cycles += 1
+            if serial.next_request == next_request:
+                break  # nothing of this cycle is in the rest of the log
+    except ReplayEnd:
+        pass
+    except Exception as e:
+        logging.warning(f"Replay stopped after {cycles} cycles: {e}")
+    elapsed = monotonic() - start
+    return {
+        "cycles": cycles,
+        "requests": serial.requests,
+        "mismatches": serial.mismatches,
+        "unmatched": serial.unmatched,
+        "line_changes": serial.line_changes,
+        "elapsed_s": round(elapsed, 3),
+        "slaves": {
+            str(channel.address): {"counters": channel.counters, "stats": channel.stats.summary()}
+            for channel in (inverter_channel, boiler_channel)
+        },
+        "inverter": dict(inverter.values) if inverter else None,
+        "heater": {"power": boiler.current_power, "temperature": boiler.current_temperature} if boiler else None,
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Replay a modbus frame log through the drivers")
+    parser.add_argument("logs", nargs="+", help="frame log files, oldest first (e.g. frames.bin.1 frames.bin)")
+    parser.add_argument("--realtime", action="store_true", help="keep the recorded response times")
+    parser.add_argument("--inverter-address", type=int, default=1)
+    parser.add_argument("--boiler-address", type=int, default=33)
+    parser.add_argument("--identity-interval", type=int, default=3600, help="cycles between identity reads")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    serial = ReplaySerial(args.logs, args.realtime)
+    results = run(serial, args.inverter_address, args.boiler_address, args.identity_interval)
+    print(
+        f"{results['cycles']} cycles, {results['requests']} requests "
+        f"({results['mismatches']} not identical to the recording, {results['unmatched']} not in it) "
+        f"in {results['elapsed_s']} s"
+    )
+    for address, slave in results["slaves"].items():
+        counters = ", ".join(f"{k} {v}" for k, v in slave["counters"].items())
+        print(f"slave {address}: {counters}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Power stage model of a heater with switched elements
+
+The heater has one relay (coil) per element. All element combinations are computed
+up front, grouped into power levels and stored in a table, so choosing the command
+for a requested power is a bisect plus two index lookups and allocates nothing.
+
+Combinations whose power differs by less than TIE_TOLERANCE are one level. Among those
+the table holds, for every current relay state, the combination with the fewest
+relay toggles, e.g. with 500/1000/1500 W elements 1500 W is reached from 500+1000 W
+without switching at all.
+
+The elements' real power differs from their rating. learn() compares the measured
+power of a steady command with the estimate and moves the estimates of the active
+elements towards it, the table is rebuilt when an estimate moved by more than
+REBUILD_THRESHOLD.
+"""
+from bisect import bisect_right
+
+TIE_TOLERANCE = 0.01  # relative power difference of combinations treated as equal
+LEARN_RATE = 0.2  # share of the measurement error applied per call
+REBUILD_THRESHOLD = 0.02  # relative estimate change that triggers a table rebuild
+MIN_MEASURED_SHARE = 0.5  # measurements below this share of the estimate are faults, not drift
+
+
+class HeaterModel:
+    def __init__(self, elements):
+        self.elements = list(elements)  # rated W, in coil order
+        self.estimates = [float(w) for w in self.elements]  # learned W
+        self.count = len(self.elements)
+        # bit lists as written to the coils, index is the bit mask
+        self.commands = [[mask >> i & 1 for i in range(self.count)] for mask in range(1 << self.count)]
+        self.off = self.commands[0]
+        self.rebuilds = 0
+        self._build()
+
+    def mask(self, bits):
+        """Bit mask of coil bits, bit i is coil i"""
+        mask = 0
+        for i, bit in enumerate(bits):
+            if bit:
+                mask |= 1 << i
+        return mask
+
+    def _combination_power(self, mask, estimates):
+        return sum(w for i, w in enumerate(estimates) if mask >> i & 1)
+
+    def _build(self):
+        self._basis = list(self.estimates)
+        combos = sorted(range(1 << self.count), key=lambda m: self._combination_power(m, self._basis))
+        levels = []  # [level power, [masks]]
+        for mask in combos:
+            power = self._combination_power(mask, self._basis)
+            if levels and power - levels[-1][0] <= TIE_TOLERANCE * levels[-1][0]:
+                levels[-1][1].append(mask)
+            else:
+                levels.append([power, [mask]])
+        self.powers = [power for power, _ in levels]  # ascending, for bisect
+        # per level and current mask the command with the fewest toggles
+        self.table = [
+            [
+                self.commands[min(masks, key=lambda m: (bin(m ^ current).count("1"), m))]
+                for current in range(1 << self.count)
+            ]
+            for _, masks in levels
+        ]
+        self.rebuilds += 1
+
+    def level(self, power):
+        """Index of the highest level not above power, -1 if even the first is above"""
+        return bisect_right(self.powers, power) - 1
+
+    def command(self, power, current=None):
+        """Coil bits of the highest level not above power, with the fewest toggles from current"""
+        level = self.level(power)
+        if level < 0:
+            return self.off
+        return self.table[level][0 if current is None else self.mask(current)]
+
+    def stage_power(self, power):
+        """Estimated W of the level used for power"""
+        level = self.level(power)
+        return self.powers[level] if level >= 0 else 0
+
+    def power(self, bits):
+        """Estimated W of a command"""
+        return self._combination_power(self.mask(bits), self.estimates)
+
+    def request(self, bits):
+        """W for which command() chooses the level of bits, the estimates drift from the table"""
+        return self._combination_power(self.mask(bits), self._basis)
+
+    def snapshot(self):
+        return {"estimates": self.estimates}
+
+    def restore(self, state):
+        """Take back learned estimates, if they are for the same elements"""
+        estimates = state.get("estimates")
+        if estimates and len(estimates) == self.count:
+            self.estimates = [float(w) for w in estimates]
+            self._build()
+
+    def learn(self, bits, measured):
+        """Adjust the element estimates to the measured power of a steady command"""
+        expected = self.power(bits)
+        if expected <= 0 or measured < MIN_MEASURED_SHARE * expected:
+            return  # heater off, thermostat open or a broken element
+        correction = LEARN_RATE * (measured - expected) / expected
+        rebuild = False
+        for i, bit in enumerate(bits):
+            if bit:
+                self.estimates[i] *= 1 + correction
+                rebuild |= abs(self.estimates[i] - self._basis[i]) > REBUILD_THRESHOLD * self._basis[i]
+        if rebuild:
+            self._build()
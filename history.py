@@ -0,0 +1,170 @@
+"""
+Compact on-device history of the heater control
+
+PV power, surplus, heater power, temperature and relay state are kept at three
+resolutions in fixed size rings:
+
+    1s      one record per update cycle, the last hour
+    1m      averages of the 1 s records, the last day
+    15m     averages of the 1 min records, the last 30 days
+
+All rings live in one preallocated buffer, so the memory use never grows. The buffer
+has the same layout as the history file and is copied to the memory mapped file only
+every flush_interval s. Until then no page of the file is dirty, so the SD card sees
+one write of some 200 kB every 15 minutes instead of a write every second.
+At startup a file with the same layout is loaded, the record in progress is lost.
+
+Averages ignore missing values (stored as NaN). The relay state of an average is the
+OR of its records, i.e. every relay that was on at some time in the interval.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+from time import monotonic
+
+FIELDS = ("pv", "surplus", "heater", "temperature")
+RECORD = struct.Struct("<I4fB3x")  # unix time, FIELDS, relay mask
+RING_HEADER = struct.Struct("<II")  # next index, number of records
+FILE_HEADER = struct.Struct("<4sHH")  # magic, version, number of rings
+MAGIC = b"PVBH"
+FILE_VERSION = 1
+
+# name, s per record, records kept
+RESOLUTIONS = (("1s", 1, 3600), ("1m", 60, 1440), ("15m", 900, 2880))
+FLUSH_INTERVAL = 900  # s between copies to the file
+MAX_POINTS = 3600  # records returned by one query
+
+
+class Ring:
+    """Fixed size ring of records in a slice of a shared buffer"""
+
+    def __init__(self, buffer, offset, resolution, capacity):
+        self.buffer = buffer
+        self.offset = offset
+        self.resolution = resolution
+        self.capacity = capacity
+        self.data = offset + RING_HEADER.size
+
+    @staticmethod
+    def size(capacity):
+        return RING_HEADER.size + capacity * RECORD.size
+
+    def append(self, timestamp, values, relays):
+        index, count = RING_HEADER.unpack_from(self.buffer, self.offset)
+        RECORD.pack_into(self.buffer, self.data + index * RECORD.size, int(timestamp), *values, relays)
+        RING_HEADER.pack_into(self.buffer, self.offset, (index + 1) % self.capacity, min(count + 1, self.capacity))
+
+    def __len__(self):
+        return RING_HEADER.unpack_from(self.buffer, self.offset)[1]
+
+    def records(self):
+        """Records from the oldest to the newest"""
+        index, count = RING_HEADER.unpack_from(self.buffer, self.offset)
+        first = (index - count) % self.capacity
+        for i in range(count):
+            yield RECORD.unpack_from(self.buffer, self.data + (first + i) % self.capacity * RECORD.size)
+
+
+class Rollup:
+    """Averages the records of one interval for the next coarser ring"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.bucket = None
+        self.reset()
+
+    def reset(self):
+        self.sums = [0.0] * len(FIELDS)
+        self.counts = [0] * len(FIELDS)
+        self.relays = 0
+
+    def add(self, timestamp, values, relays):
+        """Returns the finished average (time, values, relays) when timestamp starts a new interval"""
+        bucket = int(timestamp) // self.resolution
+        finished = None
+        if self.bucket is not None and bucket != self.bucket and any(self.counts):
+            finished = (
+                self.bucket * self.resolution,
+                [s / n if n else math.nan for s, n in zip(self.sums, self.counts)],
+                self.relays,
+            )
+            self.reset()
+        self.bucket = bucket
+        for i, value in enumerate(values):
+            if not math.isnan(value):
+                self.sums[i] += value
+                self.counts[i] += 1
+        self.relays |= relays
+        return finished
+
+
+class History:
+    def __init__(self, filename, flush_interval=FLUSH_INTERVAL):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.size = FILE_HEADER.size + sum(Ring.size(capacity) for _, _, capacity in RESOLUTIONS)
+        self.buffer = bytearray(self.size)
+        self.rings = {}
+        offset = FILE_HEADER.size
+        for name, resolution, capacity in RESOLUTIONS:
+            self.rings[name] = Ring(self.buffer, offset, resolution, capacity)
+            offset += Ring.size(capacity)
+        self.rollups = [Rollup(resolution) for _, resolution, _ in RESOLUTIONS[1:]]
+        self.map = None
+        self.last_flush = monotonic()
+        self.flushes = 0
+        self._open()
+
+    def _open(self):
+        header = FILE_HEADER.pack(MAGIC, FILE_VERSION, len(RESOLUTIONS))
+        try:
+            with open(self.filename, "a+b") as f:
+                f.seek(0)
+                if f.read(FILE_HEADER.size) == header and os.fstat(f.fileno()).st_size == self.size:
+                    f.seek(0)
+                    f.readinto(self.buffer)
+                else:
+                    f.truncate(self.size)  # new, or from another layout: start empty
+            self._file = open(self.filename, "r+b")
+            self.map = mmap.mmap(self._file.fileno(), self.size)
+        except (OSError, ValueError) as e:
+            logging.warning(f"History is not persisted, {self.filename}: {e}")
+        FILE_HEADER.pack_into(self.buffer, 0, MAGIC, FILE_VERSION, len(RESOLUTIONS))
+
+    def add(self, timestamp, pv, surplus, heater, temperature, relays):
+        """Record one update cycle, None for values not known"""
+        values = [math.nan if v is None else float(v) for v in (pv, surplus, heater, temperature)]
+        record = (timestamp, values, relays)
+        self.rings[RESOLUTIONS[0][0]].append(*record)
+        for (name, _, _), rollup in zip(RESOLUTIONS[1:], self.rollups):
+            record = rollup.add(*record)
+            if record is None:
+                break
+            self.rings[name].append(*record)
+        if monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = monotonic()
+        if self.map is None:
+            return
+        try:
+            self.map[:] = self.buffer
+            self.map.flush()
+            self.flushes += 1
+        except (OSError, ValueError) as e:
+            logging.warning(f"History flush failed: {e}")
+
+    def query(self, resolution="1m", start=0, end=None, max_points=MAX_POINTS):
+        """Records of a resolution with start <= time <= end, the newest max_points of them
+
+        Each record is [time, pv, surplus, heater, temperature, relays], NaN for missing values.
+        """
+        if resolution not in self.rings:
+            raise ValueError(f"unknown resolution {resolution}, use one of {', '.join(self.rings)}")
+        records = [
+            list(r) for r in self.rings[resolution].records() if r[0] >= start and (end is None or r[0] <= end)
+        ]
+        return records[-max_points:] if max_points else records
@@ -0,0 +1,27 @@
+"""
+D-Bus access to the History store
+
+velib_python's VeDbusService only exports values, so the bulk query is a method of an
+extra object /History on the service's bus connection:
+
+    dbus -y com.victronenergy.pvinverter.ttyUSB0 /History Query 1m 0 0 0
+
+Query(resolution, start, end, max_points) returns the records as an array of
+[time, pv, surplus, heater, temperature, relays], end 0 means up to now and
+max_points 0 means all.
+"""
+import dbus
+import dbus.service
+
+INTERFACE = "com.victronenergy.PvBoiler.History"
+
+
+class HistoryObject(dbus.service.Object):
+    def __init__(self, bus, history, path="/History"):
+        super().__init__(bus, path)
+        self.history = history
+
+    @dbus.service.method(INTERFACE, in_signature="sddu", out_signature="aad")
+    def Query(self, resolution, start, end, max_points):
+        records = self.history.query(str(resolution), start, end or None, int(max_points))
+        return dbus.Array([dbus.Array(r, signature="d") for r in records], signature="ad")
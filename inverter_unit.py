@@ -0,0 +1,132 @@
+"""
+PV inverters on the shared bus, each with its own pvinverter service
+
+The main service shows the sum of all inverters under /Ac, with more than one
+inverter each of them gets a service of its own as well. Both are filled from the
+same register values, which are polled by the service's one PollScheduler.
+
+The sum adds powers, currents and energies, voltages are the average of the units
+that answered. A unit without valid values is left out of the sum, so a dead unit
+doesn't pull the voltages to 0. Its service shows invalid values, and is marked
+disconnected once its DeviceHealth is offline.
+"""
+import platform
+
+from solis_s5_inverter import PRIO_IDENTITY
+
+PHASES = (
+    ("A phase Voltage", "A phase Current"),
+    ("B phase Voltage", "B phase Current"),
+    ("C phase Voltage", "C phase Current"),
+)
+
+# path: text of the value, the ac paths of the main and the unit services
+AC_PATHS = {
+    "/Ac/Power": "{:.0f}W",
+    "/Ac/Current": "{:.1f}A",
+    "/Ac/MaxPower": "{:.0f}W",
+    "/Ac/Energy/Forward": "{:.0f}kWh",
+    "/Ac/L1/Voltage": "{:.1f}V",
+    "/Ac/L2/Voltage": "{:.1f}V",
+    "/Ac/L3/Voltage": "{:.1f}V",
+    "/Ac/L1/Current": "{:.1f}A",
+    "/Ac/L2/Current": "{:.1f}A",
+    "/Ac/L3/Current": "{:.1f}A",
+    "/Ac/L1/Power": "{:.0f}W",
+    "/Ac/L2/Power": "{:.0f}W",
+    "/Ac/L3/Power": "{:.0f}W",
+}
+AVERAGED = ("/Ac/L1/Voltage", "/Ac/L2/Voltage", "/Ac/L3/Voltage")
+
+
+def ac_values(inverter):
+    """Values of the AC_PATHS from the inverter's register values"""
+    values = inverter.values
+    power = values["Active Power"]
+    phases = [(values[voltage], values[current]) for voltage, current in PHASES]
+    apparent = sum(v * c for v, c in phases)
+    ac = {
+        "/Ac/Power": power,
+        "/Ac/Current": sum(c for v, c in phases),
+        "/Ac/MaxPower": inverter.rated_power,
+        "/Ac/Energy/Forward": values["Energy Total"],
+    }
+    for n, (voltage, current) in enumerate(phases, 1):
+        ac[f"/Ac/L{n}/Voltage"] = voltage
+        ac[f"/Ac/L{n}/Current"] = current
+        # no per phase power register, so split the active power by the phase's share of v*i
+        ac[f"/Ac/L{n}/Power"] = power * voltage * current / apparent if apparent else power / 3
+    return ac
+
+
+def total_ac_values(inverters):
+    """Sum of the ac_values of the inverters with valid values, None values if there are none"""
+    units = [ac_values(inverter) for inverter in inverters]
+    if not units:
+        return dict.fromkeys(AC_PATHS)
+    total = {}
+    for path in AC_PATHS:
+        total[path] = sum(unit[path] for unit in units)
+        if path in AVERAGED:
+            total[path] /= len(units)
+    return total
+
+
+def identity_values(inverter):
+    values = inverter.values
+    return {
+        "/FirmwareVersion": f"DSP:{values['DSP Version']:04X}_LCD:{values['LCD Version']:04X}",
+        "/HardwareVersion": f"{values['Product Type']:04X}",
+    }
+
+
+class InverterUnit:
+    """The pvinverter service of one inverter, service is a VeDbusService and publisher its DbusPublisher"""
+
+    def __init__(self, inverter, service, publisher, deviceinstance, productname, connection, identity):
+        # identity are the /FirmwareVersion and /HardwareVersion known from before, the
+        # versions are read with the identity tier of the first polls
+        self.inverter = inverter
+        self.service = service
+        self.publisher = publisher
+        self.update_index = 0
+
+        service.add_path("/Mgmt/ProcessName", __file__)
+        service.add_path("/Mgmt/ProcessVersion", "Unkown version, and running on Python " + platform.python_version())
+        service.add_path("/Mgmt/Connection", connection)
+        service.add_path("/DeviceInstance", deviceinstance)
+        service.add_path("/ProductId", 0)
+        service.add_path("/ProductName", productname)
+        service.add_path("/Serial", inverter.serial_number)
+        service.add_path("/FirmwareVersion", identity.get("/FirmwareVersion"))
+        service.add_path("/HardwareVersion", identity.get("/HardwareVersion"))
+        service.add_path("/Connected", 1 if inverter.responding else 0)
+        for path, text in AC_PATHS.items():
+            service.add_path(path, None, gettextcallback=lambda a, x, text=text: text.format(x))
+        service.add_path("/ErrorCode", 0)
+        service.add_path("/StatusCode", 0)
+        service.add_path("/Position", 0)
+        service.add_path("/UpdateIndex", 0)
+
+    def publish(self, priorities, health):
+        """Values after a poll of the given priorities, health is the inverter's DeviceHealth"""
+        if health.valid:
+            for path, value in ac_values(self.inverter).items():
+                self.publisher[path] = value
+            if PRIO_IDENTITY in priorities:
+                for path, value in identity_values(self.inverter).items():
+                    self.publisher[path] = value
+            self.publisher["/Serial"] = self.inverter.serial_number
+            self.publisher["/Connected"] = 1
+            self.publisher["/StatusCode"] = 0
+        else:
+            self.invalidate(health.connected)
+        self.update_index = (self.update_index + 1) % 255
+        self.publisher["/UpdateIndex"] = self.update_index
+        self.publisher.flush()
+
+    def invalidate(self, connected=False):
+        for path in AC_PATHS:
+            self.publisher[path] = None
+        self.publisher["/Connected"] = 1 if connected else 0
+        self.publisher["/StatusCode"] = None
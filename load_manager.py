@@ -0,0 +1,121 @@
+"""
+Allocation of the surplus controller's power to several heaters
+
+The surplus controller decides the total power to switch to, the load manager
+splits it across the heaters: it uses the combination of power stages of all
+heaters with the highest total not above the request. Among the combinations
+within priority_margin W of that total, the heaters with the lower priority
+number get the most power, e.g. the boiler before the buffer tank.
+
+All combinations are computed up front into a table sorted by total power,
+so an allocation is a bisect and a short scan. A heater that is not connected or
+at its target temperature only has its off stage, there is one table per set of
+available heaters, built when it is needed first. All tables are dropped when a
+heater's HeaterModel learned new stage powers.
+
+Every heater has a switch timer: for switch_time s after a change it may step
+down but not up. Downsteps are never held back, they avoid grid import.
+"""
+from bisect import bisect_right
+from itertools import product
+
+PRIORITY_MARGIN = 100  # W of total power given up to feed a heater with higher priority
+
+
+class Load:
+    """A heater with its allocation settings, heater is a WaterHeater"""
+
+    def __init__(self, heater, name, priority=1, switch_time=0):
+        self.heater = heater
+        self.name = name
+        self.priority = priority  # lower numbers get the surplus first
+        self.switch_time = switch_time  # s
+        self.level = 0  # W of the allocated stage
+        self.last_switch = float("-inf")
+
+    @property
+    def available(self):
+        heater = self.heater
+        return heater.connected is True and heater.current_temperature < heater.target_temperature
+
+
+class LoadManager:
+    def __init__(self, loads, priority_margin=PRIORITY_MARGIN):
+        self.loads = sorted(loads, key=lambda load: load.priority)
+        self.priority_margin = priority_margin
+        self._tables = {}  # available per load: (totals, combinations)
+        self._rebuilds = None  # model rebuilds per load the tables were built with
+        self.switches = 0
+
+    def _table(self):
+        rebuilds = tuple(load.heater.model.rebuilds for load in self.loads)
+        if rebuilds != self._rebuilds:
+            self._tables.clear()
+            self._rebuilds = rebuilds
+        key = tuple(load.available for load in self.loads)
+        table = self._tables.get(key)
+        if table is None:
+            stages = [load.heater.model.powers if load.available else [0] for load in self.loads]
+            # sorted by total, among equal totals by the power of the heaters in priority order
+            combinations = sorted(product(*stages), key=lambda c: (sum(c), tuple(-p for p in c)))
+            table = ([sum(c) for c in combinations], combinations)
+            self._tables[key] = table
+        return table
+
+    def step_power(self, power):
+        """W of the highest total stage not above power, the quantizer for the surplus controller"""
+        totals, _ = self._table()
+        index = bisect_right(totals, power) - 1
+        return totals[index] if index >= 0 else 0
+
+    def plan(self, power, now):
+        """Stage W per load for the requested power, as allowed by the switch timers"""
+        totals, combinations = self._table()
+        held = [now - load.last_switch < load.switch_time for load in self.loads]
+        index = bisect_right(totals, power) - 1
+        while index >= 0:
+            # the combinations within the margin below the best allowed one, the first in priority order wins
+            best = None
+            floor = totals[index] - self.priority_margin
+            while index >= 0 and totals[index] >= floor:
+                combination = combinations[index]
+                if all(not h or p <= load.level for h, p, load in zip(held, combination, self.loads)):
+                    if best is None or tuple(-p for p in combination) < tuple(-p for p in best):
+                        best = combination
+                index -= 1
+            if best is not None:
+                return list(best)
+        return [0] * len(self.loads)
+
+    def apply(self, power, now):
+        """Allocate power, returns [(heater, W)] to operate the heaters with"""
+        for load, level in zip(self.loads, self.plan(power, now)):
+            if level != load.level:
+                load.level = level
+                load.last_switch = now
+                self.switches += 1
+        return [(load.heater, load.level) for load in self.loads]
+
+    def snapshot(self, now):
+        state = {}
+        for load in self.loads:
+            never = load.last_switch == float("-inf")
+            state[load.name] = {"level": load.level, "switch_age": None if never else now - load.last_switch}
+        return state
+
+    def restore(self, state, now):
+        for load in self.loads:
+            if load.name in state:
+                age = state[load.name]["switch_age"]
+                load.level = state[load.name]["level"]
+                load.last_switch = float("-inf") if age is None else now - age
+
+    @property
+    def commanded(self):
+        """W of the allocated stages"""
+        return sum(load.level for load in self.loads)
+
+    @property
+    def power(self):
+        """W the connected heaters report to draw"""
+        return sum(load.heater.current_power for load in self.loads if load.heater.connected is True)
@@ -0,0 +1,77 @@
+"""
+Update loop timer with an absolute cadence
+
+gobject.timeout_add reschedules relative to the end of the callback, so the real period
+is the loop time plus the callback duration and the loop drifts. CadenceTimer instead
+schedules every call for start + n * period. A call that starts late by more than
+LATE_FRACTION of the period is flagged, so the callback can drop non-critical work.
+Whole periods missed in between are skipped, not caught up.
+
+Overruns (callback longer than a period), skipped periods and the start jitter are counted.
+"""
+from collections import deque
+from time import monotonic
+from gi.repository import GLib as gobject
+from modbus_stats import percentile
+
+LATE_FRACTION = 0.1  # a cycle starting later than this part of the period is late
+JITTER_SAMPLES = 300
+
+
+class CadenceTimer:
+    def __init__(self, period_ms, callback):
+        """callback(late) is called every period_ms, returning False stops the timer"""
+        self.period = period_ms / 1000
+        self.callback = callback
+        self.next = None
+        self.cycles = 0
+        self.late_cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_duration = 0.0
+        self.jitter = deque(maxlen=JITTER_SAMPLES)  # start delay of each call in s
+
+    def start(self):
+        self.next = monotonic() + self.period
+        self._schedule()
+
+    def _schedule(self):
+        delay = max(0, self.next - monotonic())
+        gobject.timeout_add(int(delay * 1000), self._tick)
+
+    def _tick(self):
+        start = monotonic()
+        delay = start - self.next
+        if delay >= self.period:
+            missed = int(delay // self.period)
+            self.skipped += missed
+            self.next += missed * self.period
+            delay -= missed * self.period
+        self.jitter.append(delay)
+        late = delay > LATE_FRACTION * self.period
+        self.late_cycles += late
+        self.cycles += 1
+
+        keep_running = self.callback(late)
+
+        duration = monotonic() - start
+        self.max_duration = max(self.max_duration, duration)
+        if duration > self.period:
+            self.overruns += 1
+        self.next += self.period
+        if keep_running:
+            self._schedule()
+        return False  # every call is scheduled on its own
+
+    def summary(self):
+        jitter = sorted(self.jitter)
+        return {
+            "cycles": self.cycles,
+            "late": self.late_cycles,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_p50": None if not jitter else round(percentile(jitter, 50) * 1000, 1),
+            "jitter_p99": None if not jitter else round(percentile(jitter, 99) * 1000, 1),
+            "jitter_max": None if not jitter else round(jitter[-1] * 1000, 1),
+            "max_duration": round(self.max_duration * 1000, 1),
+        }
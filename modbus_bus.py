@@ -0,0 +1,81 @@
+"""
+Bus owner thread for the shared RS485 port
+
+All modbus transactions of all slaves run in this one thread, so the GLib main loop
+(and with it the D-Bus handling) never waits on the serial line.
+Jobs are served by priority: heater control goes ahead of telemetry. A long running
+job can call run_urgent() between its transactions to let queued control jobs in.
+The result of a job is handed back to the main loop with GLib.idle_add.
+"""
+import itertools
+import logging
+import queue
+import threading
+from gi.repository import GLib as gobject
+
+PRIO_CONTROL = 0  # heater control writes
+PRIO_TELEMETRY = 1  # inverter and heater reads
+PRIO_BACKGROUND = 2  # anything that may wait
+
+
+class BusOwner(threading.Thread):
+    def __init__(self):
+        super().__init__(name="modbus", daemon=True)
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()  # keeps jobs of the same priority in order
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._running = None
+
+    def submit(self, priority, name, function, callback=None):
+        """Queue function() to run on the bus, callback(result, error) is called in the main loop
+
+        A job is queued only once, while a job with the same name is waiting this
+        returns False. So a slow bus can't pile up work from several cycles.
+        A job that already runs doesn't count, it may have read its inputs already.
+        """
+        with self._lock:
+            if name in self._queued:
+                return False
+            self._queued.add(name)
+        self._queue.put((priority, next(self._seq), name, function, callback))
+        return True
+
+    def is_pending(self, name):
+        """True while a job with this name is waiting or running"""
+        with self._lock:
+            return name in self._queued or name == self._running
+
+    def run(self):
+        while True:
+            self._execute(self._queue.get())
+
+    def run_urgent(self):
+        """Run queued control jobs now, only to be called from inside a job"""
+        while True:
+            with self._queue.mutex:
+                if not self._queue.queue or self._queue.queue[0][0] > PRIO_CONTROL:
+                    return
+            self._execute(self._queue.get_nowait())  # this thread is the only consumer, so it's still the head
+
+    def _execute(self, job):
+        priority, _, name, function, callback = job
+        with self._lock:
+            self._queued.discard(name)
+            outer, self._running = self._running, name  # run_urgent nests one job in another
+        result, error = None, None
+        try:
+            result = function()
+        except Exception as e:
+            error = e
+        with self._lock:
+            self._running = outer
+        if callback is not None:
+            gobject.idle_add(self._deliver, callback, result, error)
+        elif error is not None:
+            logging.error(f"Modbus job {name} failed: {error}")
+
+    @staticmethod
+    def _deliver(callback, result, error):
+        callback(result, error)
+        return False  # run once
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+"""
+Modbus RTU simulator of the Solis S5 inverter and the water heater on a pseudo terminal
+
+Serves the registers used by s5_inverter and WaterHeater, so dbus-pvboiler.py and the
+test scripts can run without hardware:
+
+    python modbus_simulator.py --link /tmp/ttySIM &
+    python water_heater.py --port /tmp/ttySIM
+
+A pty has no line speed, so the wire time of each frame at the baud rate the master set
+on the port (or --baudrate, if that can't be read) is added to the answer delay, together
+with the slave latency. A slave with a list of baud rates only answers when the port is
+set to one of them and to its parity, as a real device would only see garbage otherwise.
+Dropped replies and CRC errors can be injected with a given probability.
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import select
+import struct
+import termios
+import threading
+import tty
+from time import sleep, monotonic
+
+BITS_PER_CHAR = 11
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+# termios speed constant: baud rate
+SPEEDS = {getattr(termios, f"B{b}"): b for b in (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200)}
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack("<H", crc)
+
+
+def request_length(buffer):
+    """Length of the request frame at the start of buffer, None if not known yet"""
+    if len(buffer) < 2:
+        return None
+    functioncode = buffer[1]
+    if functioncode in (1, 2, 3, 4, 5, 6):
+        return 8
+    if functioncode in (15, 16):
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    if functioncode == 23:
+        return 13 + buffer[10] if len(buffer) >= 11 else None
+    return len(buffer)  # unknown function, take what we have and answer with an exception
+
+
+class SlaveException(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class SimulatedSlave:
+    def __init__(self, address, baudrates=None, parity="N"):
+        self.address = address
+        self.baudrates = baudrates  # None: answers at any speed
+        self.parity = parity
+        self.coils = {}
+        self.discrete_inputs = {}
+        self.holding_registers = {}
+        self.input_registers = {}
+
+    def tick(self, now):
+        """Called before each request, to let the simulated values move"""
+
+    def understands(self, baudrate, parity):
+        return (self.baudrates is None or baudrate in self.baudrates) and parity == self.parity
+
+    def write_coil(self, address, value):
+        self.coils[address] = value
+
+    def write_register(self, address, value):
+        self.holding_registers[address] = value
+
+    def _bits(self, table, start, count):
+        try:
+            bits = [table[start + i] for i in range(count)]
+        except KeyError:
+            raise SlaveException(ILLEGAL_DATA_ADDRESS)
+        data = bytearray((count + 7) // 8)
+        for i, bit in enumerate(bits):
+            if bit:
+                data[i // 8] |= 1 << (i % 8)
+        return bytes([len(data)]) + bytes(data)
+
+    def _registers(self, table, start, count):
+        try:
+            words = [table[start + i] for i in range(count)]
+        except KeyError:
+            raise SlaveException(ILLEGAL_DATA_ADDRESS)
+        return bytes([2 * count]) + struct.pack(f">{count}H", *words)
+
+    def handle(self, functioncode, payload):
+        """Answer payload for a request payload, raises SlaveException"""
+        if functioncode in (1, 2, 3, 4):
+            start, count = struct.unpack(">HH", payload[:4])
+            if functioncode == 1:
+                return self._bits(self.coils, start, count)
+            if functioncode == 2:
+                return self._bits(self.discrete_inputs, start, count)
+            if functioncode == 3:
+                return self._registers(self.holding_registers, start, count)
+            return self._registers(self.input_registers, start, count)
+        if functioncode == 5:
+            address, value = struct.unpack(">HH", payload[:4])
+            if address not in self.coils:
+                raise SlaveException(ILLEGAL_DATA_ADDRESS)
+            self.write_coil(address, 1 if value == 0xFF00 else 0)
+            return payload[:4]
+        if functioncode == 6:
+            address, value = struct.unpack(">HH", payload[:4])
+            if address not in self.holding_registers:
+                raise SlaveException(ILLEGAL_DATA_ADDRESS)
+            self.write_register(address, value)
+            return payload[:4]
+        if functioncode == 15:
+            start, count = struct.unpack(">HH", payload[:4])
+            for i in range(count):
+                if start + i not in self.coils:
+                    raise SlaveException(ILLEGAL_DATA_ADDRESS)
+            for i in range(count):
+                self.write_coil(start + i, payload[5 + i // 8] >> (i % 8) & 1)
+            return payload[:4]
+        if functioncode == 16:
+            start, count = struct.unpack(">HH", payload[:4])
+            words = struct.unpack(f">{count}H", payload[5 : 5 + 2 * count])
+            for i in range(count):
+                if start + i not in self.holding_registers:
+                    raise SlaveException(ILLEGAL_DATA_ADDRESS)
+            for i, word in enumerate(words):
+                self.write_register(start + i, word)
+            return payload[:4]
+        if functioncode == 23:
+            # write first, then read, as the spec says
+            read_start, read_count, write_start, write_count = struct.unpack(">HHHH", payload[:8])
+            words = struct.unpack(f">{write_count}H", payload[9 : 9 + 2 * write_count])
+            for i in range(write_count):
+                if write_start + i not in self.holding_registers:
+                    raise SlaveException(ILLEGAL_DATA_ADDRESS)
+            for i, word in enumerate(words):
+                self.write_register(write_start + i, word)
+            self.tick(monotonic())
+            return self._registers(self.holding_registers, read_start, read_count)
+        raise SlaveException(ILLEGAL_FUNCTION)
+
+
+def _nibble_swap(b):
+    return (b & 0xF) << 12 | (b & 0xF0) << 4 | (b & 0xF00) >> 4 | (b & 0xF000) >> 12
+
+
+class SolisS5Simulator(SimulatedSlave):
+    """Solis S5 with a day like power curve, it serves the same registers with function 3 and 4"""
+
+    def __init__(self, address=1, rated_power=6000, serial="1031D02229150123", baudrates=None):
+        super().__init__(address, baudrates)
+        self.rated_power = rated_power
+        self.energy_total = 1234.0  # kWh
+        self.energy_today = 0.0
+        self._last = monotonic()
+        regs = self.input_registers
+        for address in range(2999, 3100):
+            regs[address] = 0
+        regs[2999] = _nibble_swap(0x1031)  # product type
+        regs[3000] = _nibble_swap(0x0123)  # dsp version
+        regs[3001] = _nibble_swap(0x0045)  # lcd version
+        for i in range(4):
+            regs[3060 + i] = _nibble_swap(int(serial[4 * i : 4 * i + 4], 16))
+        regs[3051] = 11000  # power limitation 110% = off
+        regs[3069] = 0x55  # power limitation switch off
+        regs[3080] = rated_power // 10  # limit power actual value in 10W
+        regs[3006] = 0xDE  # night mode off
+        # the Solis doesn't care whether registers are read as input or holding registers
+        self.holding_registers = regs
+        self.power = 0
+        self.tick(self._last)
+
+    def tick(self, now):
+        # a slow sine between 0 and 80% of the rated power, period 10 min
+        power = 0.4 * self.rated_power * (1 + math.sin(now * 2 * math.pi / 600))
+        limit = self.input_registers[3080] * 10 if self.input_registers[3069] == 0xAA else self.rated_power
+        self.power = power = int(min(power, limit))
+        self.energy_total += power * (now - self._last) / 3600000
+        self.energy_today += power * (now - self._last) / 3600000
+        self._last = now
+        regs = self.input_registers
+        regs[3004], regs[3005] = power >> 16, power & 0xFFFF
+        energy = int(self.energy_total)
+        regs[3008], regs[3009] = energy >> 16, energy & 0xFFFF
+        regs[3015] = int(self.energy_today * 10)
+        for phase in range(3):
+            regs[3033 + phase] = 2300 + phase * 5  # 0.1 V
+            regs[3036 + phase] = int(power / 3 / 230 * 10)  # 0.1 A
+        regs[3041] = 415  # 41.5 °C
+        regs[3042] = 5000  # 50.00 Hz
+        regs[3043] = 3 if power else 0  # generating / waiting
+
+
+class WaterHeaterSimulator(SimulatedSlave):
+    """Heater controller with three relays switching 500, 1000 and 2000 W elements
+
+    Besides the coils and input registers of the current firmware it serves the
+    layout of the firmware with function 23 (read/write multiple registers):
+    holding register 1 is the relay mask and 16-20 mirror the input registers 0-4.
+    """
+
+    ELEMENTS = (500, 1000, 2000)
+    RELAY_MASK = 1
+    MIRROR = 16
+
+    def __init__(self, address=33, temperature=40.0, baudrates=None):
+        super().__init__(address, baudrates)
+        self.temperature = temperature
+        self._last = monotonic()
+        self.coils = {i: 0 for i in range(len(self.ELEMENTS))}
+        self.holding_registers = {0: 0, self.RELAY_MASK: 0}  # heartbeat, relays
+        self.input_registers = {
+            0: 0,  # temperature in 0.01 °C
+            1: 0,  # heartbeat return
+            2: 0,  # power return in W
+            3: 0xE5E1,  # device type
+            4: 0,  # operation mode 0 auto, 1 force on
+        }
+        self.tick(self._last)
+
+    def write_coil(self, address, value):
+        super().write_coil(address, value)
+        self.holding_registers[self.RELAY_MASK] = sum(bit << i for i, bit in self.coils.items())
+
+    def write_register(self, address, value):
+        super().write_register(address, value)
+        if address == self.RELAY_MASK:
+            for i in self.coils:
+                self.coils[i] = value >> i & 1
+
+    def tick(self, now):
+        power = sum(watts for i, watts in enumerate(self.ELEMENTS) if self.coils[i])
+        # 200 l of water, 1.16 Wh per l and K, and some standing loss
+        self.temperature += (power - 50) * (now - self._last) / 3600 / (200 * 1.16)
+        self.temperature = max(self.temperature, 15.0)
+        self._last = now
+        regs = self.input_registers
+        regs[0] = int(self.temperature * 100)
+        regs[1] = self.holding_registers[0]
+        regs[2] = power
+        for i, value in regs.items():
+            self.holding_registers[self.MIRROR + i] = value
+
+
+class ModbusSimulator:
+    def __init__(
+        self,
+        slaves,
+        baudrate=9600,
+        latency=0.01,
+        drop_rate=0.0,
+        crc_error_rate=0.0,
+        seed=None,
+    ):
+        self.slaves = {slave.address: slave for slave in slaves}
+        self.baudrate = baudrate
+        self.latency = latency  # s between end of request and start of answer
+        self.drop_rate = drop_rate
+        self.crc_error_rate = crc_error_rate
+        self.random = random.Random(seed)
+        self.counters = {
+            "requests": 0,
+            "answered": 0,
+            "dropped": 0,
+            "crc_errors": 0,
+            "garbled": 0,
+            "wrong_speed": 0,
+        }
+        self.port = None
+        self._master = None
+        self._thread = None
+        self._running = False
+
+    def line_settings(self):
+        """Baud rate and parity the master set on the pty"""
+        try:
+            _, _, cflag, _, _, ospeed, _ = termios.tcgetattr(self._master)
+        except (termios.error, TypeError):
+            return self.baudrate, "N"
+        parity = "N" if not cflag & termios.PARENB else "O" if cflag & termios.PARODD else "E"
+        return SPEEDS.get(ospeed, self.baudrate), parity
+
+    def char_time(self, baudrate=None):
+        return BITS_PER_CHAR / (baudrate or self.baudrate)
+
+    def open(self, link=None):
+        """Create the pty, returns the port name for the modbus master"""
+        self._master, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        self._slave_fd = slave_fd  # keep it open, so the pty survives clients closing the port
+        self.port = os.ttyname(slave_fd)
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+            self.port = link
+        return self.port
+
+    def start(self, link=None):
+        """Serve in a background thread, returns the port name"""
+        port = self.open(link)
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever, name="modbus-simulator", daemon=True)
+        self._thread.start()
+        return port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def serve_forever(self):
+        self._running = True
+        buffer = b""
+        silent = max(3.5 * self.char_time(), 0.00175)
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], silent if buffer else 0.1)
+            if not readable:
+                if buffer:
+                    self.counters["garbled"] += 1  # incomplete frame followed by silence
+                    buffer = b""
+                continue
+            buffer += os.read(self._master, 512)
+            while True:
+                length = request_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                if crc16(frame[:-2]) != frame[-2:]:
+                    self.counters["garbled"] += 1
+                    buffer = b""  # resync on the next silent interval
+                    break
+                self._serve(frame)
+
+    def _serve(self, frame):
+        address, functioncode, payload = frame[0], frame[1], frame[2:-2]
+        slave = self.slaves.get(address)
+        if slave is None:
+            return  # not ours, or broadcast
+        self.counters["requests"] += 1
+        baudrate, parity = self.line_settings()
+        if not slave.understands(baudrate, parity):
+            self.counters["wrong_speed"] += 1
+            return  # the slave would have received garbage
+        slave.tick(monotonic())
+        try:
+            answer = bytes([address, functioncode]) + slave.handle(functioncode, payload)
+        except SlaveException as e:
+            answer = bytes([address, functioncode | 0x80, e.code])
+        except (struct.error, IndexError):
+            answer = bytes([address, functioncode | 0x80, ILLEGAL_DATA_VALUE])
+        answer += crc16(answer)
+
+        if self.random.random() < self.drop_rate:
+            self.counters["dropped"] += 1
+            return
+        if self.random.random() < self.crc_error_rate:
+            self.counters["crc_errors"] += 1
+            answer = answer[:-1] + bytes([answer[-1] ^ 0xFF])
+        # request and answer would take that long on a real line
+        sleep(self.latency + (len(frame) + len(answer)) * self.char_time(baudrate))
+        os.write(self._master, answer)
+        self.counters["answered"] += 1
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Modbus RTU simulator of the Solis S5 and the water heater")
+    parser.add_argument("--link", help="create a symlink with this name to the pty")
+    parser.add_argument("--baudrate", type=int, default=9600, help="simulated line speed (default: 9600)")
+    parser.add_argument("--latency", type=float, default=0.01, help="slave answer latency in s (default: 0.01)")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of a dropped reply (default: 0)")
+    parser.add_argument("--crc", type=float, default=0.0, help="probability of a reply with CRC error (default: 0)")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible error injection")
+    parser.add_argument(
+        "--inverter-address", type=int, nargs="+", default=[1], help="Modbus address of the inverters (default: 1)"
+    )
+    parser.add_argument(
+        "--boiler-address", type=int, nargs="+", default=[33], help="Modbus address of the heaters (default: 33)"
+    )
+    parser.add_argument(
+        "--inverter-baudrates", help="comma separated baud rates the inverter answers at (default: any)"
+    )
+    parser.add_argument(
+        "--boiler-baudrates", help="comma separated baud rates the heater answers at (default: any)"
+    )
+    args = parser.parse_args()
+
+    def baudrates(text):
+        return None if not text else [int(b) for b in text.split(",")]
+
+    simulator = ModbusSimulator(
+        [
+            *(
+                SolisS5Simulator(address, baudrates=baudrates(args.inverter_baudrates))
+                for address in args.inverter_address
+            ),
+            *(
+                WaterHeaterSimulator(address, baudrates=baudrates(args.boiler_baudrates))
+                for address in args.boiler_address
+            ),
+        ],
+        baudrate=args.baudrate,
+        latency=args.latency,
+        drop_rate=args.drop,
+        crc_error_rate=args.crc,
+        seed=args.seed,
+    )
+    port = simulator.open(args.link)
+    logging.info(f"Serving Modbus RTU on {port}")
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info(f"Simulator counters: {simulator.counters}")
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+
+if __name__ == "__main__":
+    main()
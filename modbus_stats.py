@@ -0,0 +1,75 @@
+"""
+Rolling statistics of modbus transactions
+
+Every transaction is recorded with its duration and outcome (ok, timeout, crc,
+invalid, illegal, error). Over a sliding time window this gives the outcome rates,
+latency percentiles of the successful transactions and the bus time lost on failed ones.
+The transactions are recorded in the bus owner thread and summarized in the main loop,
+so the sample buffer is guarded by a lock.
+"""
+import threading
+from collections import deque
+from time import monotonic
+
+WINDOW = 300  # s
+OUTCOMES = ("ok", "timeout", "crc", "invalid", "illegal", "error")
+
+
+def percentile(values, q):
+    """q-th percentile of sorted values, None for no values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class TransactionStats:
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.samples = deque()  # (time, duration, outcome)
+        self._lock = threading.Lock()
+
+    def record(self, duration, outcome, now=None):
+        now = monotonic() if now is None else now
+        with self._lock:
+            self.samples.append((now, duration, outcome))
+            while self.samples[0][0] < now - self.window:
+                self.samples.popleft()
+
+    def summary(self, now=None):
+        now = monotonic() if now is None else now
+        with self._lock:
+            samples = [s for s in self.samples if s[0] >= now - self.window]
+        counts = dict.fromkeys(OUTCOMES, 0)
+        lost = 0.0
+        latencies = []
+        for _, duration, outcome in samples:
+            counts[outcome] += 1
+            if outcome == "ok":
+                latencies.append(duration)
+            else:
+                lost += duration
+        latencies.sort()
+        total = len(samples)
+        return {
+            "count": total,
+            "per_minute": {k: v * 60 / self.window for k, v in counts.items()},
+            "error_rate": 100 * (total - counts["ok"]) / total if total else 0,  # %
+            "latency_p50": _ms(percentile(latencies, 50)),
+            "latency_p95": _ms(percentile(latencies, 95)),
+            "latency_p99": _ms(percentile(latencies, 99)),
+            "lost_time": 100 * lost / self.window,  # % of the bus time lost on failed transactions
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def block_label(method, args):
+    """D-Bus path compatible name of the register block of a transaction, like Read3004"""
+    kind = "Write" if method.startswith("write") else "Read"
+    if method.startswith("read_write"):
+        kind = "ReadWrite"
+    if method.endswith("bits"):
+        kind += "Bits"
+    return f"{kind}{args[0]}" if args else kind
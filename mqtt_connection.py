@@ -0,0 +1,136 @@
+"""
+MQTT connection state machine with jittered exponential backoff
+
+The connection is driven by the mqtt pipeline thread calling step() regularly, so
+neither a connect nor a reconnect ever runs in the GLib main loop or delays startup.
+The last will is set before the first connect, as paho requires. The subscriptions
+are renewed on every connect.
+
+    disconnected -> connecting -> connected
+         ^              |             |
+         +-- backoff <--+-------------+
+
+After a failed attempt or a lost connection the next attempt waits a random time
+between half and all of the current delay, the delay doubles up to backoff_max.
+
+reconfigure() switches to another broker or last will with a clean disconnect and an
+immediate connect, changed subscriptions are renewed on the running connection.
+"""
+import logging
+import random
+from time import monotonic
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+
+CONNECT_TIMEOUT = 10  # s to wait for the broker's CONNACK
+LOOP_TIMEOUT = 0.05  # s the network loop may wait for socket activity in one step
+
+
+class MqttConnection:
+    def __init__(
+        self,
+        client,
+        broker_address,
+        will_topic,
+        port=1883,
+        keepalive=60,
+        backoff_min=1,
+        backoff_max=300,
+        subscriptions=(),
+    ):
+        self.client = client
+        self.subscriptions = list(subscriptions)
+        self.broker_address = broker_address
+        self.will_topic = will_topic
+        self.port = port
+        self.keepalive = keepalive
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.delay = backoff_min
+        self.state = DISCONNECTED
+        self.since = monotonic()  # time of the last state change
+        self.next_attempt = 0
+        self.random = random.Random()
+        client.will_set(will_topic, "offline", retain=True)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+
+    @property
+    def connected(self):
+        return self.state == CONNECTED
+
+    def _set_state(self, state):
+        self.state = state
+        self.since = monotonic()
+
+    def _backoff(self):
+        wait = self.random.uniform(self.delay / 2, self.delay)
+        self.next_attempt = monotonic() + wait
+        self.delay = min(self.delay * 2, self.backoff_max)
+        self._set_state(BACKOFF)
+        logging.info(f"MQTT: next connect attempt to {self.broker_address} in {wait:.1f}s")
+
+    def step(self):
+        """Connect when due and run the network loop once, called from the mqtt thread"""
+        now = monotonic()
+        if self.state in (DISCONNECTED, BACKOFF):
+            if now < self.next_attempt:
+                return
+            self._set_state(CONNECTING)
+            try:
+                self.client.connect(self.broker_address, self.port, self.keepalive)
+            except Exception as e:
+                logging.warning(f"MQTT: failed to connect to {self.broker_address}: {e}")
+                self._backoff()
+                return
+        if self.state == CONNECTING and now - self.since > CONNECT_TIMEOUT:
+            logging.warning(f"MQTT: no answer from {self.broker_address}")
+            self.client.disconnect()
+            self._backoff()
+            return
+        rc = self.client.loop(LOOP_TIMEOUT)
+        if rc != 0 and self.state != BACKOFF:
+            self._backoff()  # the socket broke without a disconnect callback
+
+    def reconfigure(self, broker_address, will_topic, subscriptions):
+        """New broker, last will or subscriptions, called from the mqtt thread"""
+        subscriptions = list(subscriptions)
+        if broker_address != self.broker_address or will_topic != self.will_topic:
+            # in backoff the disconnect callback doesn't schedule another wait
+            self._set_state(BACKOFF)
+            self.next_attempt = 0
+            self.delay = self.backoff_min
+            self.client.disconnect()
+            self.client.loop(LOOP_TIMEOUT)  # sends the disconnect
+            self.broker_address = broker_address
+            self.will_topic = will_topic
+            self.subscriptions = subscriptions
+            self.client.will_set(will_topic, "offline", retain=True)
+            logging.info(f"MQTT: switching to {broker_address}")
+            return
+        if self.connected:
+            for topic in set(self.subscriptions) - set(subscriptions):
+                self.client.unsubscribe(topic)
+            for topic in set(subscriptions) - set(self.subscriptions):
+                self.client.subscribe(topic)
+        self.subscriptions = subscriptions
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logging.info("Connected to MQTT Broker " + self.broker_address)
+            self.delay = self.backoff_min
+            self._set_state(CONNECTED)
+            for topic in self.subscriptions:
+                client.subscribe(topic)
+        else:
+            logging.error("Failed to connect, return code %d", rc)
+            self._backoff()
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logging.info("Unexpected MQTT disconnect. Will reconnect")
+        if self.state != BACKOFF:
+            self._backoff()
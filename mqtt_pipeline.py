@@ -0,0 +1,166 @@
+"""
+MQTT telemetry pipeline
+
+The update loop only puts a sample (dict of topic name: value) into a bounded queue,
+publishing happens in this thread, so the control loop never pays for broker latency.
+If the queue is full the oldest entry is dropped.
+
+Modes:
+    topics  one message per value on its own topic (legacy)
+    json    one compact message per cycle on the "samples" topic
+    cbor    the same, CBOR encoded (needs cbor2, falls back to json)
+
+A value (or in the compact modes the whole sample) is published when it changed or
+when it was last published max_age s ago. While the broker is not connected samples
+go into a fixed size ring buffer. After reconnect they are replayed as compact
+messages with their timestamp on the "samples" topic.
+
+The thread also drives the MqttConnection, so the client is used by this thread only.
+A new configuration from reconfigure() is taken over by the thread as well, between
+two messages.
+"""
+import json
+import logging
+import queue
+import threading
+from collections import deque
+from time import time, monotonic
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+_MISSING = object()
+QUEUE_TIMEOUT = 0.05  # s to wait for a sample before the connection is served again
+
+
+class MqttPipeline(threading.Thread):
+    def __init__(
+        self,
+        client,
+        topics,
+        connection,
+        mode="topics",
+        max_age=60,
+        queue_size=100,
+        buffer_size=3600,
+    ):
+        super().__init__(name="mqtt", daemon=True)
+        self.client = client
+        self.topics = topics
+        self.connection = connection
+        if mode == "cbor" and cbor2 is None:
+            logging.warning("cbor2 not installed, publishing MQTT samples as json")
+            mode = "json"
+        self.mode = mode
+        self.max_age = max_age
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.buffer = deque(maxlen=buffer_size)  # samples missed while offline
+        self.last = {}  # name: (value, time published)
+        self.published = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.last_publish = None  # monotonic time of the last successful publish
+        self._lock = threading.Lock()
+        self._pending = None  # configuration waiting for the thread
+
+    def reconfigure(self, topics, mode, max_age, broker_address, will_topic, subscriptions):
+        """New topics, publishing mode and broker, applied by the mqtt thread, never blocks"""
+        if mode == "cbor" and cbor2 is None:
+            mode = "json"
+        with self._lock:
+            self._pending = (dict(topics), mode, max_age, broker_address, will_topic, list(subscriptions))
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        topics, mode, max_age, broker_address, will_topic, subscriptions = pending
+        if topics != self.topics or mode != self.mode:
+            self.last.clear()  # everything is due on the new topics
+        self.topics = topics
+        self.mode = mode
+        self.max_age = max_age
+        self.connection.reconfigure(broker_address, will_topic, subscriptions)
+
+    def submit(self, sample):
+        """Queue a sample dict, never blocks"""
+        self._put(("sample", time(), sample))
+
+    def send(self, name, payload):
+        """Queue a single message for the topic name, never blocks"""
+        self._put(("message", name, payload))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.dropped += 1
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                self._apply_pending()
+                self.connection.step()
+            except Exception as e:
+                logging.warning(f"MQTT failure: {e}")
+            try:
+                kind, a, b = self.queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            try:
+                if kind == "message":
+                    if self.connection.connected:
+                        self._publish(self.topics[a], b)
+                elif not self.connection.connected:
+                    self.buffer.append((a, b))
+                else:
+                    self._replay()
+                    self._publish_sample(a, b)
+            except Exception as e:
+                logging.warning(f"MQTT failure: {e}")
+
+    def _encode(self, timestamp, sample):
+        payload = dict(sample, ts=round(timestamp, 3))
+        if self.mode == "cbor":
+            return cbor2.dumps(payload)
+        return json.dumps(payload)
+
+    def _publish(self, topic, payload):
+        info = self.client.publish(topic, payload)
+        self.published += 1
+        if getattr(info, "rc", 0) == 0:
+            self.last_publish = monotonic()
+
+    def seconds_since_publish(self):
+        return None if self.last_publish is None else monotonic() - self.last_publish
+
+    def _due(self, name, value, now):
+        last, published = self.last.get(name, (_MISSING, 0))
+        return value != last or now - published >= self.max_age
+
+    def _publish_sample(self, timestamp, sample):
+        if self.mode == "topics":
+            for name, value in sample.items():
+                if self._due(name, value, timestamp):
+                    self._publish(self.topics[name], value)
+                    self.last[name] = (value, timestamp)
+        elif self._due("samples", sample, timestamp):
+            self._publish(self.topics["samples"], self._encode(timestamp, sample))
+            self.last["samples"] = (dict(sample), timestamp)
+
+    def _replay(self):
+        while self.buffer:
+            timestamp, sample = self.buffer.popleft()
+            self._publish(self.topics["samples"], self._encode(timestamp, sample))
+            self.replayed += 1
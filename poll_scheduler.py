@@ -0,0 +1,100 @@
+"""
+Tiered polling of modbus devices with a bus time budget per update cycle
+
+Every device register tier has a read interval in update cycles. Mandatory
+tiers are read every cycle, all others are read when they are due and the
+estimated wire time still fits in front of the cycle deadline.
+Deferred tiers stay due and are tried first in the next cycle.
+
+A device needs two methods:
+    estimate(priorities) -> estimated bus time in s to read these tiers together
+    poll(priorities, yield_to=None) -> read these tiers, calling yield_to() between requests
+
+yield_to lets the bus serve urgent jobs (heater control) between two reads of a
+long poll, so control never waits for more than one transaction.
+
+Several devices share one budget. Their mandatory tiers are always read, the
+optional ones as long as they fit, starting with another device every cycle, so
+with many devices on a busy bus the deferrals are spread over all of them.
+"""
+from timeit import default_timer as timer
+
+BITS_PER_CHAR = 11  # start + 8 data + parity/stop bits, as used by the modbus spec
+SILENT_CHARS = 3.5  # inter frame silence of modbus rtu
+TURNAROUND = 0.02  # typical slave processing time between request and response in s
+
+READ_REQUEST_BYTES = 8  # address, function, start, count, crc
+READ_RESPONSE_OVERHEAD = 5  # address, function, byte count, crc
+
+
+def char_time(baudrate):
+    return BITS_PER_CHAR / baudrate
+
+
+def transaction_time(baudrate, request_bytes, response_bytes, turnaround=TURNAROUND):
+    """Estimated bus time of one request/response including both silent intervals"""
+    return (request_bytes + response_bytes + 2 * SILENT_CHARS) * char_time(baudrate) + turnaround
+
+
+def read_time(baudrate, count, turnaround=TURNAROUND):
+    """Estimated bus time of reading count registers in one request"""
+    return transaction_time(baudrate, READ_REQUEST_BYTES, READ_RESPONSE_OVERHEAD + 2 * count, turnaround)
+
+
+class PollScheduler:
+    def __init__(self, budget, yield_to=None):
+        self.budget = budget  # s of bus time per cycle
+        self.yield_to = yield_to
+        self.cycle = 0
+        self.devices = []  # [device, {priority: interval}, {priority: last read cycle}, mandatory]
+        self.deferred = 0  # number of due tier reads pushed to a later cycle
+
+    def add(self, device, tiers, mandatory=()):
+        last = {priority: -interval for priority, interval in tiers.items()}
+        self.devices.append([device, tiers, last, tuple(mandatory)])
+
+    def retier(self, device, tiers):
+        """New read intervals for a device, the cycles of its last reads are kept"""
+        for entry in self.devices:
+            if entry[0] is device:
+                last = entry[2]
+                entry[1] = dict(tiers)
+                entry[2] = {priority: last.get(priority, -interval) for priority, interval in tiers.items()}
+
+    def run(self, deadline=None, skip=()):
+        """Poll all devices once, reading everything that is due and fits until deadline
+
+        deadline is a timer() value, default is now plus the budget. Devices in skip,
+        e.g. offline ones, are left out, their tiers stay due.
+        Returns the list of polled (device, priorities).
+        """
+        start = timer()
+        if deadline is None:
+            deadline = start + self.budget
+        deadline = min(deadline, start + self.budget)
+
+        polled = []
+        first = self.cycle % len(self.devices) if self.devices else 0
+        for device, tiers, last, mandatory in self.devices[first:] + self.devices[:first]:
+            if device in skip:
+                continue
+            selected = list(mandatory)
+            # due tiers, lowest priority number first and among those the most overdue
+            due = sorted(
+                (p for p, interval in tiers.items() if p not in mandatory and self.cycle - last[p] >= interval),
+                key=lambda p: (p, last[p] - self.cycle + tiers[p]),
+            )
+            for priority in due:
+                if timer() + device.estimate(selected + [priority]) <= deadline:
+                    selected.append(priority)
+                else:
+                    self.deferred += 1
+            if not selected:
+                continue
+            device.poll(selected, self.yield_to)
+            for priority in selected:
+                last[priority] = self.cycle
+            polled.append((device, selected))
+
+        self.cycle += 1
+        return polled
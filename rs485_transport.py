@@ -0,0 +1,339 @@
+"""
+Transport for one physical RS485 port shared by several modbus slaves
+
+minimalmodbus shares the serial port of all instruments with the same port name and
+keeps the 3.5 character silent interval from the end of the latest read on that
+port. What it doesn't know about is a slave that answers after its timeout or a
+garbled frame still on the line: that would spoil the next transaction, possibly
+with another slave. So after every failed transaction the line is drained until it
+has been silent for 3.5 characters, which costs a few ms instead of a fixed sleep.
+
+Each slave has its own timeout profile, set on the shared port before each of its
+transactions, and its own transaction counters. Every transaction is timed and
+recorded per slave and per register block for the rolling statistics.
+
+The timeout is learned from the response times actually observed: a high percentile
+plus margin, within the profile's min/max. It is learned per register block too, so a
+known slow block gets its own longer timeout while all others stay short. Until a block
+has enough samples, the slave's estimate is used. After a timeout the next transaction
+waits twice as long, once: a slave that misses that too is silent, not slow.
+
+Every slave has a serial profile with its own line settings. The shared port is switched
+to them before each of the slave's transactions. At startup probe() tries the profile's
+candidate baud rates, fastest first, and keeps the first one the slave answers reliably
+at. After FALLBACK_ERRORS failed transactions in a row the slave steps down to the next
+slower candidate, and finally to FALLBACK_BAUDRATE.
+
+The port can record all frames to a FrameLog, or be replaced by a serial look-alike
+like ReplaySerial to run the drivers against a recorded log, see frame_log.
+"""
+import logging
+import minimalmodbus
+import struct
+from collections import deque
+from functools import partial
+from time import monotonic
+from poll_scheduler import char_time, SILENT_CHARS, READ_REQUEST_BYTES, READ_RESPONSE_OVERHEAD
+from modbus_stats import TransactionStats, block_label, percentile
+from frame_log import RecordingSerial
+
+MINIMUM_SILENT_TIME = 0.00175  # fixed silent interval above 19200 baud, see modbus spec
+RESYNC_MAX = 0.5  # s, give up draining a babbling line after this time
+
+TIMEOUT_SAMPLES = 50  # response times kept per estimator
+TIMEOUT_MIN_SAMPLES = 10  # use the initial timeout until there are this many
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_FACTOR = 1.5
+TIMEOUT_MARGIN = 0.01  # s, scheduling and usb latency
+TIMEOUT_BACKOFF = 2  # a timed out block waits this multiple of its estimate next time
+TIMEOUT_SILENT_AFTER = 2  # timeouts in a row after which a slave is taken as silent, not slow
+
+FALLBACK_BAUDRATE = 9600  # every modbus device supports it, used when nothing faster works
+FALLBACK_ERRORS = 10  # failed transactions in a row that make a slave step down to a slower baud rate
+PROBE_ATTEMPTS = 5  # reads that must all succeed for a baud rate to be used
+
+
+def classify(e):
+    """Short name for the outcome of a failed transaction"""
+    if isinstance(e, minimalmodbus.NoResponseError):
+        return "timeout"
+    if isinstance(e, minimalmodbus.InvalidResponseError):
+        return "crc" if "Checksum" in str(e) else "invalid"
+    if isinstance(e, minimalmodbus.IllegalRequestError):
+        return "illegal"
+    return "error"
+
+
+def read_write_registers(instrument, read_start, read_count, write_start, values):
+    """Write values and read read_count holding registers in one transaction (function 23)
+
+    minimalmodbus has no function 23, so the frame is built and checked with its
+    internal helpers and sent with the instrument's _communicate, which keeps the silent
+    interval of the port. RTU only, the response size is known up front.
+    """
+    payload = struct.pack(
+        f">HHHHB{len(values)}H", read_start, read_count, write_start, len(values), 2 * len(values), *values
+    )
+    request = minimalmodbus._embed_payload(instrument.address, instrument.mode, 23, payload)
+    response = instrument._communicate(request, 5 + 2 * read_count)
+    data = minimalmodbus._extract_payload(response, instrument.address, instrument.mode, 23)
+    if len(data) != 1 + 2 * read_count or data[0] != 2 * read_count:
+        raise minimalmodbus.InvalidResponseError(f"Wrong byte count in function 23 response: {data!r}")
+    return list(struct.unpack(f">{read_count}H", data[1:]))
+
+
+class TimeoutEstimator:
+    def __init__(self, initial, minimum, maximum):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.samples = deque(maxlen=TIMEOUT_SAMPLES)
+        self.estimate = initial
+        self.backoff = 1
+        self.misses = 0  # timeouts in a row
+
+    def ready(self):
+        return len(self.samples) >= TIMEOUT_MIN_SAMPLES
+
+    def observe(self, response_time):
+        self.samples.append(response_time)
+        self.backoff = 1
+        self.misses = 0
+        if self.ready():
+            high = percentile(sorted(self.samples), TIMEOUT_PERCENTILE)
+            self.estimate = min(max(high * TIMEOUT_FACTOR + TIMEOUT_MARGIN, self.minimum), self.maximum)
+
+    def failed(self):
+        # wait longer once, so a slow answer can still be observed and raise the estimate.
+        # a slave that misses that too is silent, e.g. an inverter at night: it costs the estimate
+        self.misses += 1
+        self.backoff = TIMEOUT_BACKOFF if self.misses < TIMEOUT_SILENT_AFTER else 1
+
+    @property
+    def timeout(self):
+        return min(self.estimate * self.backoff, self.maximum)
+
+
+class SerialProfile:
+    """Line settings and timeouts of one slave
+
+    baudrates are the candidates to probe, the slowest is used until probe() ran.
+    timeout is used until response times are known, then it is learned within min/max. All in s.
+    """
+
+    def __init__(self, baudrates=(FALLBACK_BAUDRATE,), parity="N", timeout=0.2, min_timeout=0.03, max_timeout=0.5):
+        self.baudrates = sorted(set(baudrates), reverse=True)  # fastest first
+        self.parity = parity
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+
+class Rs485Port:
+    """serial replaces the pyserial port, frame_log records every frame of the port"""
+
+    def __init__(self, port, baudrate=FALLBACK_BAUDRATE, serial=None, frame_log=None):
+        self.port = port
+        self.baudrate = baudrate  # of the port until a slave switches it
+        self.slaves = {}  # address: SlaveChannel
+        self.frame_log = frame_log
+        if serial is not None:
+            # minimalmodbus gives all instruments of a port name the registered port
+            minimalmodbus._serialports[port] = serial
+
+    def attach(self, instrument):
+        """Wrap the instrument's port in the frame recorder, once per port"""
+        if self.frame_log is not None and not isinstance(instrument.serial, RecordingSerial):
+            instrument.serial = minimalmodbus._serialports[self.port] = RecordingSerial(
+                instrument.serial, self.frame_log
+            )
+
+    def slave(self, address, profile=None):
+        """Instrument like channel to one slave, with the given SerialProfile"""
+        if address not in self.slaves:
+            self.slaves[address] = SlaveChannel(self, address, profile or SerialProfile((self.baudrate,)))
+        return self.slaves[address]
+
+    def silent_time(self, baudrate=None):
+        return max(SILENT_CHARS * char_time(baudrate or self.baudrate), MINIMUM_SILENT_TIME)
+
+    def resync(self, serial):
+        """Discard input until the line has been silent for 3.5 characters"""
+        timeout = serial.timeout
+        serial.timeout = self.silent_time(serial.baudrate)
+        try:
+            end = monotonic() + RESYNC_MAX
+            while serial.read(256) and monotonic() < end:
+                pass  # still receiving the rest of a garbled or late frame
+        finally:
+            serial.timeout = timeout
+        serial.reset_input_buffer()
+
+
+class SlaveChannel:
+    """Access to one slave, with the read/write methods of minimalmodbus.Instrument"""
+
+    def __init__(self, port, address, profile):
+        self.port = port
+        self.address = address
+        self.profile = profile
+        self.timeout_profile = (profile.timeout, profile.min_timeout, profile.max_timeout)
+        self.timeouts = TimeoutEstimator(*self.timeout_profile)
+        self.block_timeouts = {}  # block label: TimeoutEstimator
+        self.instrument = minimalmodbus.Instrument(port.port, address)
+        port.attach(self.instrument)
+        self.baudrate = profile.baudrates[-1]
+        self.parity = profile.parity
+        self.throughput = None  # bytes/s measured by probe()
+        self.fallbacks = 0
+        self.errors_in_row = 0
+        self.counters = {
+            "requests": 0,
+            "ok": 0,
+            "timeout": 0,
+            "crc": 0,
+            "invalid": 0,
+            "illegal": 0,
+            "error": 0,
+        }
+        self.stats = TransactionStats()
+        self.block_stats = {}  # block label: TransactionStats
+
+    @property
+    def serial(self):
+        return self.instrument.serial
+
+    def describe(self):
+        """Line settings as usually written, like 19200 8N1"""
+        return f"{self.baudrate} 8{self.parity}1"
+
+    def _apply(self, serial):
+        # the port is shared, so it may still have another slave's settings
+        if serial.baudrate != self.baudrate:
+            serial.baudrate = self.baudrate
+        if serial.parity != self.parity:
+            serial.parity = self.parity
+
+    def _set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        self.errors_in_row = 0
+        # response times depend on the line speed, learn them again
+        self.timeouts = TimeoutEstimator(*self.timeout_profile)
+        self.block_timeouts = {label: TimeoutEstimator(*self.timeout_profile) for label in self.block_timeouts}
+
+    def probe(self, check, attempts=PROBE_ATTEMPTS, known=None):
+        """Use the fastest candidate baud rate at which check succeeds attempts times in a row
+
+        check(channel) reads from the slave and returns the number of registers read.
+        known is the baud rate the slave used before, if it's still a candidate one
+        successful check at it is enough.
+        Returns the baud rate used from now on, FALLBACK_BAUDRATE if no candidate worked.
+        """
+        candidates = [(b, attempts) for b in self.profile.baudrates]
+        if known in self.profile.baudrates:
+            candidates.insert(0, (known, 1))
+        for baudrate, tries in candidates:
+            self._set_baudrate(baudrate)
+            transferred, elapsed = 0, 0.0
+            try:
+                for _ in range(tries):
+                    start = monotonic()
+                    registers = check(self)
+                    elapsed += monotonic() - start
+                    transferred += READ_REQUEST_BYTES + READ_RESPONSE_OVERHEAD + 2 * registers
+            except Exception as e:
+                logging.info(f"Slave {self.address} doesn't answer reliably at {baudrate} baud: {e}")
+                continue
+            self.throughput = transferred / elapsed if elapsed else None
+            logging.info(f"Slave {self.address} uses {self.describe()}, {self.throughput or 0:.0f} bytes/s")
+            return baudrate
+        logging.warning(f"Slave {self.address} didn't answer at any of {self.profile.baudrates}, using {FALLBACK_BAUDRATE}")
+        self._set_baudrate(FALLBACK_BAUDRATE)
+        return FALLBACK_BAUDRATE
+
+    def _step_down(self):
+        slower = [b for b in self.profile.baudrates if b < self.baudrate] or [FALLBACK_BAUDRATE]
+        logging.warning(
+            f"Slave {self.address}: {self.errors_in_row} failed transactions at {self.baudrate} baud, "
+            f"falling back to {slower[0]}"
+        )
+        self.fallbacks += 1
+        self.throughput = None
+        self._set_baudrate(slower[0])
+
+    @property
+    def timeout(self):
+        return self.timeouts.timeout
+
+    def block_timeout(self, label):
+        estimator = self.block_timeouts.get(label)
+        if estimator is not None and estimator.ready():
+            return estimator.timeout
+        return self.timeouts.timeout
+
+    def _record(self, label, start, outcome):
+        now = monotonic()
+        if label not in self.block_stats:
+            self.block_stats[label] = TransactionStats()
+            self.block_timeouts[label] = TimeoutEstimator(*self.timeout_profile)
+        self.counters[outcome] += 1
+        self.stats.record(now - start, outcome, now)
+        self.block_stats[label].record(now - start, outcome, now)
+        if outcome == "ok":
+            # roundtrip_time is write to end of read, without the silent interval before the write
+            response_time = getattr(self.instrument, "roundtrip_time", None) or now - start
+            self.timeouts.observe(response_time)
+            self.block_timeouts[label].observe(response_time)
+        elif outcome == "timeout":
+            self.timeouts.failed()
+            self.block_timeouts[label].failed()
+
+    def _call(self, method, *args, **kwargs):
+        # method is the name of an Instrument method or a function taking the instrument first
+        if isinstance(method, str):
+            label, function = block_label(method, args), getattr(self.instrument, method)
+        else:
+            label, function = block_label(method.__name__, args), partial(method, self.instrument)
+        serial = self.instrument.serial
+        self._apply(serial)
+        serial.timeout = self.block_timeout(label)
+        self.counters["requests"] += 1
+        start = monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            outcome = classify(e)
+            if outcome in ("timeout", "crc", "invalid"):
+                self.port.resync(serial)
+                self.errors_in_row += 1
+            self._record(label, start, outcome)
+            if self.errors_in_row >= FALLBACK_ERRORS and self.baudrate > FALLBACK_BAUDRATE:
+                self._step_down()
+            raise
+        self.errors_in_row = 0
+        self._record(label, start, "ok")
+        return result
+
+    def read_register(self, *args, **kwargs):
+        return self._call("read_register", *args, **kwargs)
+
+    def read_registers(self, *args, **kwargs):
+        return self._call("read_registers", *args, **kwargs)
+
+    def read_long(self, *args, **kwargs):
+        return self._call("read_long", *args, **kwargs)
+
+    def read_bits(self, *args, **kwargs):
+        return self._call("read_bits", *args, **kwargs)
+
+    def write_register(self, *args, **kwargs):
+        return self._call("write_register", *args, **kwargs)
+
+    def write_registers(self, *args, **kwargs):
+        return self._call("write_registers", *args, **kwargs)
+
+    def write_bits(self, *args, **kwargs):
+        return self._call("write_bits", *args, **kwargs)
+
+    def read_write_registers(self, *args, **kwargs):
+        return self._call(read_write_registers, *args, **kwargs)
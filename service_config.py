@@ -0,0 +1,117 @@
+"""
+Settings of the service from config.ini
+
+The file is optional and so is every option in it, an option that is not given
+keeps its default, the constants at the top of dbus-pvboiler.py. The file is
+validated as a whole: one invalid option rejects all of it, so the service either
+gets a complete change or keeps running with the settings it has.
+
+    [mqtt]
+    broker = 192.168.168.112
+    mode = json
+    [topics]
+    heaterpower = home/boiler/power
+    [control]
+    surplus_offset = 150
+    looptime = 1000
+    [bus]
+    inverter_addresses = 1, 2
+
+The service checks the file for changes while it runs and applies them in place.
+Only the slave addresses need a restart, the probed slaves and the D-Bus services
+of the inverters depend on them.
+"""
+import configparser
+
+from surplus_controller import CONTROLLERS
+
+MQTT_MODES = ("topics", "json", "cbor")
+
+
+def _addresses(text):
+    return [int(a) for a in text.replace(",", " ").split()]
+
+
+def _boolean(text):
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[text.lower()]
+    except KeyError:
+        raise ValueError(f"not a boolean: {text}")
+
+
+def _slave(address):
+    return 1 <= address <= 247
+
+
+# setting: section, option, parse, check, what the check expects
+OPTIONS = {
+    "broker_address": ("mqtt", "broker", str, bool, "a host name or address"),
+    "mqtt_mode": ("mqtt", "mode", str, lambda v: v in MQTT_MODES, ", ".join(MQTT_MODES)),
+    "mqtt_max_age": ("mqtt", "max_age", float, lambda v: v > 0, "s above 0"),
+    "controller": ("control", "controller", str, lambda v: v in CONTROLLERS, ", ".join(CONTROLLERS)),
+    "surplus_offset": ("control", "surplus_offset", float, lambda v: -5000 <= v <= 5000, "W from -5000 to 5000"),
+    "looptime": ("control", "looptime", int, lambda v: 200 <= v <= 10000, "ms from 200 to 10000"),
+    "boiler_is_optional": ("control", "boiler_is_optional", _boolean, lambda v: True, "yes or no"),
+    "bus_budget": ("bus", "budget", int, lambda v: v > 0, "ms above 0"),
+    "ac_read_interval": ("bus", "ac_read_interval", int, lambda v: v >= 1, "cycles, at least 1"),
+    "identity_read_interval": ("bus", "identity_read_interval", int, lambda v: v >= 1, "cycles, at least 1"),
+    "inverter_addresses": (
+        "bus",
+        "inverter_addresses",
+        _addresses,
+        lambda v: v and len(set(v)) == len(v) and all(_slave(a) for a in v),
+        "different modbus IDs from 1 to 247",
+    ),
+    "boiler_address": ("bus", "boiler_address", int, _slave, "a modbus ID from 1 to 247"),
+}
+RESTART_OPTIONS = ("inverter_addresses", "boiler_address")  # applied at the next start only
+
+
+def load_config(filename, defaults):
+    """The defaults with the options of the file, the defaults if there is no file
+
+    defaults has all settings of OPTIONS and "topics". Raises ValueError if the file
+    can't be parsed or any option is unknown or invalid.
+    """
+    config = dict(defaults, topics=dict(defaults["topics"]))
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(filename) as f:
+            parser.read_file(f)
+    except FileNotFoundError:
+        return config
+    except configparser.Error as e:
+        raise ValueError(f"{filename}: {e}") from e
+
+    known = {(section, option): name for name, (section, option, *_) in OPTIONS.items()}
+    for section in parser.sections():
+        for option, text in parser.items(section):
+            if section == "topics":
+                if option not in config["topics"]:
+                    raise ValueError(f"[topics] {option}: unknown topic")
+                if not text or "+" in text or "#" in text:
+                    raise ValueError(f"[topics] {option}: a topic without wildcards expected")
+                config["topics"][option] = text
+                continue
+            name = known.get((section, option))
+            if name is None:
+                raise ValueError(f"[{section}] {option}: unknown option")
+            _, _, parse, check, expected = OPTIONS[name]
+            try:
+                value = parse(text)
+            except ValueError:
+                value = None
+            if value is None or not check(value):
+                raise ValueError(f"[{section}] {option} = {text}: {expected} expected")
+            config[name] = value
+
+    if config["bus_budget"] >= config["looptime"]:
+        raise ValueError("[bus] budget must be shorter than [control] looptime")
+    if config["boiler_address"] in config["inverter_addresses"]:
+        raise ValueError("[bus] boiler_address is one of the inverter_addresses")
+    return config
+
+
+def changes(old, new):
+    """Names of the settings that differ"""
+    return {name for name in new if new[name] != old.get(name)}
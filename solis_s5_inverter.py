@@ -1,107 +1,133 @@
+import logging
 import minimalmodbus
 from time import sleep
-from typing import Tuple
+from register_map import plan_blocks
+from poll_scheduler import read_time
+
+# read priorities
+PRIO_CONTROL = 0  # needed by the heater control path
+PRIO_AC = 1  # ac telemetry
+PRIO_IDENTITY = 2  # static device information
+
+REGISTERS = {
+  # name        : nr , format, factor, unit, priority
+  "Product Type": [2999, 'X16', 1, '', PRIO_IDENTITY],
+  "DSP Version": [3000, 'X16', 1, '', PRIO_IDENTITY],
+  "LCD Version": [3001, 'X16', 1, '', PRIO_IDENTITY],
+  "Active Power": [3004, 'U32', 1, 'W', PRIO_CONTROL],
+  "Energy Total": [3008, 'U32', 1, 'kWh', PRIO_AC],
+  "Energy Today": [3015, 'U16', 0.1, 'kWh', PRIO_AC],
+  "A phase Voltage": [3033, 'U16', 0.1, 'V', PRIO_AC],
+  "B phase Voltage": [3034, 'U16', 0.1, 'V', PRIO_AC],
+  "C phase Voltage": [3035, 'U16', 0.1, 'V', PRIO_AC],
+  "A phase Current": [3036, 'U16', 0.1, 'A', PRIO_AC],
+  "B phase Current": [3037, 'U16', 0.1, 'A', PRIO_AC],
+  "C phase Current": [3038, 'U16', 0.1, 'A', PRIO_AC],
+  "Inverter Temperature": [3041, 'U16', 0.1, '°C', PRIO_AC],
+  "Grid Frequency": [3042, 'U16', 0.01, 'Hz', PRIO_AC],
+  "Status": [3043, 'U16', 1, '', PRIO_AC],
+  "Inverter SN_1": [3060, 'X16', 1, '', PRIO_IDENTITY],
+  "Inverter SN_2": [3061, 'X16', 1, '', PRIO_IDENTITY],
+  "Inverter SN_3": [3062, 'X16', 1, '', PRIO_IDENTITY],
+  "Inverter SN_4": [3063, 'X16', 1, '', PRIO_IDENTITY],
+}
 
 
 '''Solis S5 Inverter Interface'''
 class s5_inverter:
-  def __init__(self, instrument: minimalmodbus.Instrument, rated_power=6000):
+  # known_serial is the serial number the inverter had last time, if any
+  def __init__(self, instrument: minimalmodbus.Instrument, rated_power=6000, known_serial=None):
     self._dbusservice = []
     self.rated_power = rated_power
     self.bus = instrument
+    self.values = {name: 0 for name in REGISTERS}
+    self.responding = True  # False while the inverter doesn't answer its polls
+    self.poll_error = None  # the last failed block read of the last poll, None if all went well
 
-    #use serial number production code to detect solis inverters
-    ser = self.read_serial()
-    if not self.check_production_date(ser):
-      raise RuntimeError("Unknown Device")
-
-   
-  #returns kWh
-  def read_energy_today(self):
-    try:
-      return self.bus.read_register(3015,1,4)
-    except minimalmodbus.ModbusException:
-      return 0
-
-  # returns V, A for phase 1-3
-  def read_phase(self, phase_no: int) -> Tuple[float, float]:
-    if phase_no<1 or phase_no>3:
-      return 0, 0
-    try:
-      voltage = self.bus.read_register(3032 + phase_no,1,4)
-      current = self.bus.read_register(3035 + phase_no,1,4)
-      return voltage, current
-    except minimalmodbus.ModbusException:
-      return 0
+    self._plans = {}  # read plans per combination of priorities
 
-  #returns kWh
-  def read_energy_total(self):
-    try:
-      return self.bus.read_long(3008,4)
-    except minimalmodbus.ModbusException:
-      return 0
+    self.serial_blocks = plan_blocks({k: v for k, v in REGISTERS.items() if k.startswith("Inverter SN")})
 
-  #returns W
-  def read_active_power(self):
-    try:
-      return self.bus.read_long(3004,4)
-    except minimalmodbus.ModbusException:
-      return 0
+    #use serial number production code to detect solis inverters
+    #a known inverter is checked with one read, and accepted without an answer: it sleeps at night
+    #an unknown one that doesn't answer is identified later, see identify()
+    if known_serial:
+      ser = self.read_serial(tries=1)
+      if not ser:
+        self.responding = False
+        ser = known_serial
+    else:
+      ser = self.read_serial()
+      if not ser:
+        self.responding = False
+    self.serial_number = ser
+    if ser and not self.check_production_date(ser):
+      raise RuntimeError("Unknown Device")
 
-  def read_status(self):
-    for _ in range(3):
+  # reads the serial number of an inverter that didn't answer at startup, True once it is known
+  def identify(self):
+    if not self.serial_number:
+      ser = self.read_serial(tries=1)
+      if ser and not self.check_production_date(ser):
+        raise RuntimeError("Unknown Device")
+      self.serial_number = ser
+    return bool(self.serial_number)
+
+  # blocks to read the given priorities together, cached because the poll scheduler asks every cycle
+  def plan(self, priorities):
+    key = tuple(sorted(priorities))
+    if key not in self._plans:
+      self._plans[key] = plan_blocks(REGISTERS, key)
+    return self._plans[key]
+
+  # estimated bus time in s to read the given priorities
+  def estimate(self, priorities):
+    baudrate = getattr(self.bus, "baudrate", None) or self.bus.serial.baudrate  # the channel's own, the port may be shared
+    return sum(read_time(baudrate, block.count) for block in self.plan(priorities))
+
+  # reads the registers of the given priorities, returns the values dict
+  # values of a failed block read are set to 0, like the single register reads do
+  # yield_to() is called after each block, so the bus can serve urgent jobs in between
+  # after a timeout the rest of the poll is skipped: a silent inverter costs one timeout, not one per block
+  def poll(self, priorities, yield_to=None):
+    blocks = self.plan(priorities)
+    self.poll_error = None
+    for n, block in enumerate(blocks):
       try:
-        status = int(self.bus.read_register(3043, 0, 4))
-        return status
-      except minimalmodbus.ModbusException:
-        pass # igonore sporadic checksum or noreply errors but raise others
-    
-    # print(f'Inverter Status: {status:04X}') # 0 waiting, 3 generating
-    return 0
-
-
-  def _to_little_endian(self, b):
-    return (b&0xf)<<12 | (b&0xf0)<<4 | (b&0xf00)>>4 | (b&0xf000)>>12
+        block.read(self.bus, self.values)
+        self.responding = True
+      except minimalmodbus.NoResponseError as e:
+        self.responding = False
+        self.poll_error = e
+        for skipped in blocks[n:]:
+          for name, *_ in skipped.fields:
+            self.values[name] = 0
+        break
+      except minimalmodbus.ModbusException as e:
+        self.poll_error = e
+        for name, *_ in block.fields:
+          self.values[name] = 0
+      finally:
+        if yield_to is not None:
+          yield_to()
+    return self.values
 
 
-  def read_serial(self):
-    for _ in range(6):
+  def read_serial(self, tries=6):
+    for attempt in range(tries):
       try:
         serial = {}
-        serial["Inverter SN_1"] = self._to_little_endian(int(self.bus.read_register(3060, 0, 4)))
-        serial["Inverter SN_2"] = self._to_little_endian(int(self.bus.read_register(3061, 0, 4)))
-        serial["Inverter SN_3"] = self._to_little_endian(int(self.bus.read_register(3062, 0, 4)))
-        serial["Inverter SN_4"] = self._to_little_endian(int(self.bus.read_register(3063, 0, 4)))
+        for block in self.serial_blocks:
+          block.read(self.bus, serial)
         serial_str = f'{serial["Inverter SN_1"]:04X}{serial["Inverter SN_2"]:04X}{serial["Inverter SN_3"]:04X}{serial["Inverter SN_4"]:04X}'
         return serial_str
       except minimalmodbus.ModbusException as e:
-        print(e)
-        sleep(1)
-        pass
+        logging.debug(f"serial number read failed: {e}")
+        if attempt < tries - 1:
+          sleep(1)
     return ''
 
 
-  def read_type(self):
-    try:
-      return f'{self._to_little_endian(int(self.bus.read_register(2999, 0, 4))):04X}'
-    except minimalmodbus.ModbusException:
-      return ''
-
-    
-  def read_dsp_version(self):
-    try:
-      return f'{self._to_little_endian(int(self.bus.read_register(3000, 0, 4))):04X}'
-    except minimalmodbus.ModbusException:
-      return ''
-    
-
-  def read_lcd_version(self):
-    try:
-      return f'{self._to_little_endian(int(self.bus.read_register(3001, 0, 4))):04X}'
-    except minimalmodbus.ModbusException:
-      return ''
-
-
   def check_production_date(self, serial):
     try:
       year = int(serial[7:9])
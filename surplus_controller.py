@@ -0,0 +1,169 @@
+"""
+Surplus controllers deciding the heater power
+
+A controller is called with the latest measurements and returns the heater power
+in W to switch to, or None to keep the current power stage:
+
+    update(grid_power, heater_power, pv_power, now) -> W or None
+
+    grid_power      W at the grid meter, import positive, export negative
+    heater_power    W the heater reports to draw
+    pv_power        W of the inverter, None if there's no new reading (grid meter event)
+    now             s, a monotonic clock
+
+The heater maps the returned power to its largest power stage below it.
+Downsteps are always returned at once, the controllers only differ in when they step up.
+
+snapshot(now) returns the controller state as a dict for a restart, restore(state, now)
+takes it back. Times are stored as ages, now is the clock of the respective process.
+
+    rules   the original fixed rules, target is surplus minus a fixed offset
+    pi      PI control of the grid power to a small export, with PV trend feed-forward
+"""
+
+MINIMUM_SWITCH_TIME = 60  # shortest allowed time between boiler switching actions
+SMALL_STEP = 500  # W, upsteps up to this size may switch after a tenth of MINIMUM_SWITCH_TIME
+
+
+class RuleController:
+    """Immediate downsteps, 6 s for small upsteps, 60 s for large ones"""
+
+    name = "rules"
+
+    def __init__(self, offset=200, switch_time=MINIMUM_SWITCH_TIME, small_step=SMALL_STEP):
+        self.offset = offset  # W that must be generated more than the heater would consume
+        self.switch_time = switch_time
+        self.small_step = small_step
+        self.last_target = 0
+        self.last_switch = float("-inf")
+
+    def update(self, grid_power, heater_power, pv_power, now):
+        # grid feed-in is counted negative, target is the surplus plus what is currently burned
+        target = -grid_power - self.offset + heater_power
+        step = target - self.last_target
+        self.last_target = target
+        if step >= 0:
+            wait = self.switch_time / 10 if step <= self.small_step else self.switch_time
+            if now - self.last_switch < wait:
+                return None
+        self.last_switch = now
+        return target
+
+    def snapshot(self, now):
+        return {"last_target": self.last_target, "switch_age": _age(self.last_switch, now)}
+
+    def restore(self, state, now):
+        self.last_target = state["last_target"]
+        self.last_switch = _since(state["switch_age"], now)
+
+
+class PiController:
+    """PI control of the grid power with feed-forward of heater power and PV trend
+
+    The request is the measured heater power plus kp * error plus the integral, where the
+    error is the export beyond `reserve`. The integral is limited, so at most
+    integral_limit W of import are traded for using a power stage earlier.
+    The PV trend (W/s, smoothed over trend_time) times feed_forward s is added, so the
+    heater steps down before a passing cloud shows up as grid import.
+    The request is quantized to the heater's power stages. An upstep needs hysteresis W
+    more than the stage and upstep_time s since the last switch, downsteps are immediate.
+    """
+
+    name = "pi"
+
+    def __init__(
+        self,
+        quantize=None,
+        reserve=50,
+        kp=1.0,
+        ki=0.05,
+        integral_limit=100,
+        feed_forward=5,
+        trend_time=10,
+        hysteresis=100,
+        upstep_time=MINIMUM_SWITCH_TIME / 10,
+    ):
+        self.quantize = quantize or (lambda power: power)  # W -> W of the stage the heater would use
+        self.reserve = reserve
+        self.kp = kp
+        self.ki = ki
+        self.integral_limit = integral_limit
+        self.feed_forward = feed_forward
+        self.trend_time = trend_time
+        self.hysteresis = hysteresis
+        self.upstep_time = upstep_time
+        self.integral = 0.0
+        self.trend = 0.0  # W/s
+        self.stage = 0  # W of the last requested stage
+        self.last_time = None
+        self.last_pv = None  # (time, power)
+        self.last_switch = float("-inf")
+
+    def _update_trend(self, pv_power, now):
+        if self.last_pv is not None:
+            dt = now - self.last_pv[0]
+            if dt <= 0:
+                return
+            slope = (pv_power - self.last_pv[1]) / dt
+            self.trend += min(1.0, dt / self.trend_time) * (slope - self.trend)
+        self.last_pv = (now, pv_power)
+
+    def update(self, grid_power, heater_power, pv_power, now):
+        dt = 0 if self.last_time is None else now - self.last_time
+        self.last_time = now
+        if pv_power is not None:
+            self._update_trend(pv_power, now)
+
+        error = -grid_power - self.reserve
+        self.integral += self.ki * error * dt
+        self.integral = max(-self.integral_limit, min(self.integral_limit, self.integral))
+        request = heater_power + self.kp * error + self.integral + self.feed_forward * self.trend
+        stage = self.quantize(max(0, request))
+        if stage > self.stage:
+            stage = max(self.stage, self.quantize(max(0, request - self.hysteresis)))
+            if stage == self.stage or now - self.last_switch < self.upstep_time:
+                return None
+        elif stage < self.stage:
+            self.integral = min(self.integral, 0)  # don't carry the export history into a downstep
+        else:
+            return None
+        self.stage = stage
+        self.last_switch = now
+        return stage
+
+    def snapshot(self, now):
+        return {
+            "integral": self.integral,
+            "trend": self.trend,
+            "stage": self.stage,
+            "switch_age": _age(self.last_switch, now),
+        }
+
+    def restore(self, state, now):
+        self.integral = state["integral"]
+        self.trend = state["trend"]
+        self.stage = state["stage"]
+        self.last_switch = _since(state["switch_age"], now)
+
+
+def _age(time, now):
+    # s since time, None for never, json has no infinity
+    return None if time == float("-inf") else now - time
+
+
+def _since(age, now):
+    return float("-inf") if age is None else now - age
+
+
+CONTROLLERS = {
+    RuleController.name: RuleController,
+    PiController.name: PiController,
+}
+
+
+def make_controller(name, quantize=None, offset=200):
+    if name == RuleController.name:
+        return RuleController(offset)
+    if name == PiController.name:
+        return PiController(quantize)
+    raise ValueError(f"unknown surplus controller {name}, use one of {', '.join(CONTROLLERS)}")
@@ -0,0 +1,86 @@
+"""
+State kept across restarts of the driver
+
+devices     identity of every slave seen before: baud rate, serial number, versions.
+            A known slave is validated with one read at its baud rate instead of
+            being probed, and its versions are shown until the first identity poll.
+control     heater heartbeats, relay commands, learned element powers and the state
+            of the surplus controller and load manager, saved every SAVE_INTERVAL s.
+            After a restart within MAX_CONTROL_AGE s the control resumes where it
+            stopped, the learned element powers are used after any downtime.
+
+Times in the control state are ages in s at the time of saving, the monotonic clock
+of the next process has another origin. The file is replaced atomically.
+"""
+import json
+import logging
+import os
+from time import time
+
+SAVE_INTERVAL = 60  # s
+MAX_CONTROL_AGE = 300  # s, older control state is not resumed
+
+
+class WarmStart:
+    def __init__(self, filename, save_interval=SAVE_INTERVAL, max_control_age=MAX_CONTROL_AGE):
+        self.filename = filename
+        self.save_interval = save_interval
+        self.max_control_age = max_control_age
+        self.devices = {}  # str(address): identity
+        self.control = {}
+        self.control_time = None  # unix time the control state was taken
+        self.last_save = time()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            self.devices = dict(data.get("devices", {}))
+            self.control = dict(data.get("control", {}))
+            self.control_time = data.get("control_time")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.warning(f"Warm start state not loaded from {self.filename}: {e}")
+
+    def device(self, address):
+        """Cached identity of a slave, {} if it wasn't seen before"""
+        return self.devices.get(str(address), {})
+
+    def remember(self, address, **identity):
+        """Update the identity of a slave, saved at once if it changed"""
+        known = self.devices.setdefault(str(address), {})
+        if any(known.get(k) != v for k, v in identity.items()):
+            known.update(identity)
+            self.save()
+
+    def downtime(self):
+        """s since the control state was taken, None if there is none"""
+        return None if self.control_time is None else max(0.0, time() - self.control_time)
+
+    def resumable(self):
+        """The control state if it is recent enough to resume, else None"""
+        downtime = self.downtime()
+        if downtime is None or downtime > self.max_control_age or not self.control:
+            return None
+        return self.control
+
+    def due(self):
+        return time() - self.last_save >= self.save_interval
+
+    def save(self, control=None):
+        self.last_save = time()
+        if control is not None:
+            self.control = control
+            self.control_time = self.last_save
+        temporary = self.filename + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                data = {"devices": self.devices, "control": self.control, "control_time": self.control_time}
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            logging.warning(f"Warm start state not saved to {self.filename}: {e}")
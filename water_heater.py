@@ -1,18 +1,24 @@
 import minimalmodbus
 from time import sleep
-from datetime import datetime as dt
-from datetime import timedelta
+from timeit import default_timer as timer
 import logging
 import sys
 import argparse
+from heater_model import HeaterModel
 
-MINIMUM_SWITCH_TIME = 60  # shortest allowed time between boiler switching actions
+ELEMENTS = [500, 1000, 2000]  # W of the heating elements, in coil order
+INPUT_COUNT = 5  # input registers 0-4 are read as one block
+COIL_REFRESH = 60  # calls after which unchanged relays are written again, in case the heater restarted
 
 
 class WaterHeater:
-    def __init__(self, instrument: minimalmodbus.Instrument):
+    def __init__(self, instrument: minimalmodbus.Instrument, elements=ELEMENTS, read_write_multiple=False):
         self._dbusservice = []
         self.instrument = instrument
+        self.model = HeaterModel(elements)
+        # firmware with function 23: heartbeat and relay mask are written and the
+        # mirrored inputs read in a single transaction
+        self.read_write_multiple = read_write_multiple
 
         self.registers = {
             "Power_500W": 0,
@@ -24,43 +30,25 @@ class WaterHeater:
             "Device_Type": 3,
             "Operation_Mode": 4,  # AUTO/FORCE ON
             "Heartbeat": 0,
+            "Relay_Mask": 1,  # function 23 firmware only
+            "Input_Mirror": 16,  # function 23 firmware only, holding registers 16-20 mirror inputs 0-4
         }
 
-        self.powersteps = [
-            (-1000000, 499),
-            (500, 999),
-            (1000, 1499),
-            (1500, 1999),
-            (2000, 2499),
-            (2500, 2999),
-            (3000, 3499),
-            (3500, 1000000),
-        ]
-        self.powercommands = [
-            [0, 0, 0],
-            [1, 0, 0],
-            [0, 1, 0],
-            [1, 1, 0],
-            [0, 0, 1],
-            [1, 0, 1],
-            [0, 1, 1],
-            [1, 1, 1],
-        ]
-        self.lasttime_switched = dt.now() - timedelta(seconds=MINIMUM_SWITCH_TIME)
         self.target_temperature = 50  # °C
         self.current_temperature = float()
         self.current_power = int()
         self.status = None  # 0 Auto, 1 FORCE ON
         self.heartbeat = 0
+        self.heartbeat_return = None
         self.Device_Type = 0xE5E1
-        self.exception_counter = 0
-        self.Max_Retries = 10
-        self.last_grid_surplus = 0
-        self.cmd_bits = [0, 0, 0]
+        self.cmd_bits = self.model.off
+        self.written_bits = None  # shadow of the relay state the heater acknowledged
+        self.coil_age = 0  # calls since the relays were last written
+        self.command_time = None  # timer() when the relay command was last acknowledged
         self.connected = False
+        self.responding = True  # False if the last operate failed on the bus
 
-    def check_device_type(self):
-        maxtries = 3
+    def check_device_type(self, maxtries=3):
         tried = 0
         found_type = 0
         for _ in range(maxtries):
@@ -83,79 +71,96 @@ class WaterHeater:
         raise RuntimeError("No Device found")
 
     def calc_powercmd(self, grid_surplus):
-        res = None
-        for idx in (
-            idx
-            for idx, (sec, fir) in enumerate(self.powersteps)
-            if sec <= grid_surplus <= fir
-        ):
-            res = idx
-        return self.powercommands[res]
-
-    def operate(self, grid_surplus):
+        # highest power stage not above grid_surplus, reached with the fewest relay toggles
+        return self.model.command(grid_surplus, self.cmd_bits)
+
+    def step_power(self, power):
+        """W of the power stage the heater would use for power"""
+        return self.model.stage_power(power)
+
+    def snapshot(self):
+        return {"heartbeat": self.heartbeat, "relays": self.model.mask(self.cmd_bits), "model": self.model.snapshot()}
+
+    def restore(self, state, resume):
+        # learned element powers are kept across any downtime, the relay state only if it's recent
+        self.model.restore(state.get("model", {}))
+        if resume:
+            self.heartbeat = state["heartbeat"]
+            self.cmd_bits = self.model.commands[state["relays"]]
+
+    def _acknowledge(self):
+        self.written_bits = self.cmd_bits
+        self.coil_age = 0
+        self.command_time = timer()
+
+    def operate(self, power):
         # needs to be called regularly (e.g. 1/s) to update the heartbeat
+        # power is the request of the surplus controller, the switching rules are applied there
 
         if self.connected is not True:
             return
 
         try:
-            self.instrument.write_register(
-                self.registers["Heartbeat"], self.heartbeat, 0, 16
-            )
+            steady = True  # relays unchanged since the last call, so Power_Return belongs to them
+            cmd_bits = self.calc_powercmd(power)
+            if cmd_bits is not self.cmd_bits:
+                steady = False
+                self.cmd_bits = cmd_bits
+
+            # but stop heating if target temperature is reached
+            # the relays are switched with the temperature of the last call, the fresh one
+            # arrives in the same transaction or right after
+            if self.current_temperature >= self.target_temperature:
+                steady &= self.cmd_bits is self.model.off
+                self.cmd_bits = self.model.off
+
+            if self.read_write_multiple:
+                inputs = self.instrument.read_write_registers(
+                    self.registers["Input_Mirror"],
+                    INPUT_COUNT,
+                    self.registers["Heartbeat"],
+                    [self.heartbeat, self.model.mask(self.cmd_bits)],
+                )
+                self._acknowledge()
+            else:
+                # relays first, a downstep reaches the heater with the first transaction
+                if self.cmd_bits is not self.written_bits or self.coil_age >= COIL_REFRESH:
+                    self.instrument.write_bits(self.registers["Power_500W"], self.cmd_bits)
+                    self._acknowledge()
+                self.instrument.write_register(
+                    self.registers["Heartbeat"], self.heartbeat, 0, 16
+                )
+                inputs = self.instrument.read_registers(
+                    self.registers["Temperature"], INPUT_COUNT, 4
+                )
+            self.coil_age += 1
             self.heartbeat += 1
             if self.heartbeat >= 100:  # must be below 1000 for the server to work
                 self.heartbeat = 0
 
-            # switch to apropriate power level, if last switching incident is longer than the allowed minimum time ago
-            # short delay for small steps, long delay for steps>500W, immediately switch for downsteps
-            powerstep = grid_surplus - self.last_grid_surplus
-            if powerstep < 0:
-                self.cmd_bits = self.calc_powercmd(
-                    grid_surplus
-                )  # calculate power setting depending on energy surplus
-                self.lasttime_switched = dt.now()
-            elif powerstep <= 500:
-                if (
-                    dt.now() - self.lasttime_switched
-                ).total_seconds() >= MINIMUM_SWITCH_TIME / 10:
-                    self.cmd_bits = self.calc_powercmd(
-                        grid_surplus
-                    )  # calculate power setting depending on energy surplus
-                    self.lasttime_switched = dt.now()
-            else:
-                if (
-                    dt.now() - self.lasttime_switched
-                ).total_seconds() >= MINIMUM_SWITCH_TIME:
-                    self.cmd_bits = self.calc_powercmd(
-                        grid_surplus
-                    )  # calculate power setting depending on energy surplus
-                    self.lasttime_switched = dt.now()
-
-            # but stop heating if target temperature is reached
-            self.current_temperature = float(self.instrument.read_register(
-                self.registers["Temperature"], 2, 4
-            ))
-            if self.current_temperature >= self.target_temperature:
-                self.cmd_bits = [0, 0, 0]
-
-            self.instrument.write_bits(self.registers["Power_500W"], self.cmd_bits)
-            self.last_grid_surplus = grid_surplus
-
-            self.current_power = int(self.instrument.read_register(
-                self.registers["Power_Return"], 0, 4
-            ))
-            self.status = int(self.instrument.read_register(
-                self.registers["Operation_Mode"], 0, 4
-            ))
-            self.exception_counter = 0  # reset counter after successful access
-
-        except minimalmodbus.NoResponseError as e:  # TODO remove later
-            self.exception_counter = 0
-        except Exception as e:
-            logging.info(e)
-            if self.exception_counter >= self.Max_Retries:
-                raise RuntimeError(f"Water Heater critical error, exiting {e}")
-            self.exception_counter += 1
+            self.current_temperature = inputs[self.registers["Temperature"]] / 100
+            self.heartbeat_return = inputs[self.registers["Heartbeat_Return"]]
+            self.current_power = inputs[self.registers["Power_Return"]]
+            self.status = inputs[self.registers["Operation_Mode"]]
+            if inputs[self.registers["Device_Type"]] != self.Device_Type:
+                raise RuntimeError(f"Unexpected device type {inputs[self.registers['Device_Type']]:X}")
+
+            if self.current_temperature >= self.target_temperature and any(self.cmd_bits):
+                steady = False
+                self.cmd_bits = self.model.off
+                if self.read_write_multiple:
+                    self.instrument.write_register(self.registers["Relay_Mask"], 0, 0, 16)
+                else:
+                    self.instrument.write_bits(self.registers["Power_500W"], self.cmd_bits)
+                self._acknowledge()
+            elif steady:
+                self.model.learn(self.cmd_bits, self.current_power)
+            self.responding = True
+
+        except minimalmodbus.ModbusException as e:
+            # bus errors are counted by the caller's health tracking, anything else is raised
+            logging.debug(f"Water Heater: {e}")
+            self.responding = False
 
 
 if __name__ == "__main__":